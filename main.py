@@ -25,6 +25,9 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from pyrogram import Client
 
 from plugins import glovar
+from plugins.functions.file import flush_files
+from plugins.functions.pool import shutdown_pools
+from plugins.functions.regex import flush_count
 from plugins.functions.timers import backup_files, interval_hour_01, interval_min_15, reset_data, send_count
 from plugins.functions.timers import update_admins, update_status, white_check
 
@@ -35,11 +38,23 @@ logger = logging.getLogger(__name__)
 app = Client(session_name="account")
 app.start()
 
+# Wait for the data load, stop if a data file is corrupted
+glovar.preload_thread and glovar.preload_thread.join()
+
+if glovar.load_failed:
+    app.stop()
+    raise SystemExit(f"[DATA CORRUPTION] {glovar.load_failed}")
+
 # Send online status
 update_status(app, "online")
 
+# Report the data load time
+glovar.preload or print(glovar.report_load())
+
 # Timer
 scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
+scheduler.add_job(flush_count, "interval", minutes=1)
+scheduler.add_job(flush_files, "interval", seconds=glovar.time_save)
 scheduler.add_job(interval_min_15, "interval", [app], minutes=15)
 scheduler.add_job(interval_hour_01, "interval", [app], hours=1)
 scheduler.add_job(update_status, "cron", [app, "awake"], minute=30)
@@ -53,5 +68,15 @@ scheduler.start()
 # Hold
 app.idle()
 
-# Stop
+# Stop the timers, then finish the queued tasks before the client stops
+scheduler.shutdown(wait=True)
+shutdown_pools()
 app.stop()
+
+# Save pending data
+flush_count()
+flush_files()
+
+# Exit with an error if a data file loaded lazily is corrupted
+if glovar.load_failed:
+    raise SystemExit(f"[DATA CORRUPTION] {glovar.load_failed}")
@@ -157,6 +157,8 @@ def check_limit(values: dict, broken: bool) -> str:
     for key in values:
         if values[key] <= 0:
             result += f"[ERROR] [limit] {key} - should be a positive integer\n"
+        elif key == "limit_quality" and values[key] > 95:
+            result += f"[ERROR] [limit] {key} - should not be greater than 95\n"
 
         if not broken or not result:
             continue
@@ -182,6 +184,26 @@ def check_mode(values: dict, broken: bool) -> str:
     return result
 
 
+def check_storage(values: dict, broken: bool) -> str:
+    # Check all values in storage section
+    result = ""
+
+    for key in values:
+        if key == "backend" and values[key] not in {"pickle", "sqlite"}:
+            result += f"[ERROR] [storage] {key} - please choose pickle or sqlite\n"
+        elif key == "cache_size" and values[key] <= 0:
+            result += f"[ERROR] [storage] {key} - should be a positive integer\n"
+        elif key == "preload" and values[key] not in {False, True}:
+            result += f"[ERROR] [storage] {key} - please fill a valid boolean value\n"
+
+        if not broken or not result:
+            continue
+
+        raise_error(result)
+
+    return result
+
+
 def check_time(values: dict, broken: bool) -> str:
     # Check all values in time section
     result = ""
@@ -189,7 +211,7 @@ def check_time(values: dict, broken: bool) -> str:
     for key in values:
         if key == "date_reset" and values[key] in {"", "[DATA EXPUNGED]"}:
             result += f"[ERROR] [time] {key} - please fill a correct format string\n"
-        elif key in {"time_new", "time_old"} and values[key] <= 0:
+        elif key in {"time_deleted", "time_new", "time_old", "time_read", "time_save"} and values[key] <= 0:
             result += f"[ERROR] [time] {key} - should be a positive integer\n"
 
         if not broken or not result:
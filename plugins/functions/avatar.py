@@ -0,0 +1,202 @@
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from typing import NamedTuple, Optional
+
+from PIL import Image
+from pyrogram import Client
+
+from .. import glovar
+from .channel import share_user_avatar, share_user_avatar_reference
+from .file import get_downloaded_path, get_new_path
+from .ids import set_user_avatar
+from .pool import submit
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+class AvatarJob(NamedTuple):
+    # A pending job to share a user's avatar
+    gid: int
+    uid: int
+    mid: int
+    file_id: str
+
+
+def add_avatar_job(client: Client, gid: int, uid: int, mid: int, file_id: str, block: bool = False) -> bool:
+    # Add a job to share a user's avatar, a pending job of the same user is replaced by the new one
+    result = False
+
+    try:
+        job = AvatarJob(gid, uid, mid, file_id)
+
+        with glovar.locks["avatar"]:
+            pending = uid in glovar.avatar_jobs
+            glovar.avatar_jobs[uid] = job
+
+        if pending:
+            return True
+
+        # The handlers never wait for a full queue, the timers wait for the workers
+        while not submit("avatar", share_pending_avatar, (client, uid), block=block):
+            with glovar.locks["avatar"]:
+                # Drop only the job added here, a newer job that replaced it waits for this task, so submit again
+                if glovar.avatar_jobs.get(uid, job) is job:
+                    glovar.avatar_jobs.pop(uid, None)
+                    logger.warning(f"Avatar queue is full, drop the job of user {uid}")
+                    return False
+
+                job = glovar.avatar_jobs[uid]
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Add avatar job error: {e}", exc_info=True)
+
+    return result
+
+
+def get_avatar_hash(path: str) -> Optional[int]:
+    # Get the difference hash of an image, similar images have hashes with a small Hamming distance
+    # Return None if the image can not be hashed
+    result = None
+
+    try:
+        with Image.open(path) as image:
+            # Let the JPEG decoder scale down the image, the full size is not needed
+            image.draft("L", (32, 32))
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+
+        the_hash = 0
+
+        for row in range(8):
+            for col in range(8):
+                the_hash = (the_hash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+
+        result = the_hash
+    except Exception as e:
+        logger.warning(f"Get avatar hash error: {e}", exc_info=True)
+
+    return result
+
+
+def get_avatar_thumbnail(path: str) -> str:
+    # Get a downscaled JPEG copy of an image in tmp directory
+    result = ""
+
+    try:
+        size = (glovar.limit_thumbnail, glovar.limit_thumbnail)
+        file_path = get_new_path(".jpg")
+
+        with Image.open(path) as image:
+            image.draft("RGB", size)
+            image = image.convert("RGB")
+            image.thumbnail(size)
+            image.save(file_path, "JPEG", quality=glovar.limit_quality, optimize=True)
+
+        result = file_path
+    except Exception as e:
+        logger.warning(f"Get avatar thumbnail error: {e}", exc_info=True)
+
+    return result
+
+
+def get_similar_avatar(the_hash: int, uid: int) -> int:
+    # Get the user whose recently shared avatar is similar to the hash
+    result = 0
+
+    try:
+        with glovar.locks["avatar"]:
+            hashes = list(glovar.avatar_hashes.ids.items())
+
+        for previous_hash, previous_uid in reversed(hashes):
+            if previous_uid == uid:
+                continue
+
+            if bin(the_hash ^ previous_hash).count("1") <= glovar.hash_distance:
+                return previous_uid
+    except Exception as e:
+        logger.warning(f"Get similar avatar error: {e}", exc_info=True)
+
+    return result
+
+
+def share_avatar(client: Client, job: AvatarJob) -> bool:
+    # Download the user's avatar and share it
+    result = False
+
+    try:
+        set_user_avatar(job.uid, job.file_id)
+
+        # Download the avatar only if it is not cached
+        image_path = glovar.avatar_cache.get(job.file_id)
+
+        if not image_path:
+            downloaded_path = get_downloaded_path(client, job.file_id, "")
+            image_path = downloaded_path and glovar.avatar_cache.put(job.file_id, downloaded_path)
+
+        if not image_path:
+            return False
+
+        # An identical image has been shared for the user
+        if glovar.avatar_cache.is_shared(image_path, job.uid):
+            return True
+
+        # An image that can not be hashed is never compared
+        the_hash = get_avatar_hash(image_path)
+        same_id = the_hash is not None and get_similar_avatar(the_hash, job.uid)
+
+        # Refer to the avatar of a previous user instead of sharing a near-duplicate image
+        if same_id:
+            share_user_avatar_reference(client, job.gid, job.uid, job.mid, same_id)
+            return True
+
+        # Share the encoded image as it is, or a smaller copy of it
+        file = glovar.thumbnail and get_avatar_thumbnail(image_path) or image_path
+        result = share_user_avatar(client, job.gid, job.uid, job.mid, file)
+
+        if not result:
+            return False
+
+        glovar.avatar_cache.mark_shared(image_path, job.uid)
+
+        if the_hash is None:
+            return result
+
+        with glovar.locks["avatar"]:
+            glovar.avatar_hashes.add(the_hash, job.uid)
+    except Exception as e:
+        logger.warning(f"Share avatar error: {e}", exc_info=True)
+
+    return result
+
+
+def share_pending_avatar(client: Client, uid: int) -> bool:
+    # Share the latest pending avatar of the user
+    result = False
+
+    try:
+        with glovar.locks["avatar"]:
+            job = glovar.avatar_jobs.pop(uid, None)
+
+        result = bool(job) and share_avatar(client, job)
+    except Exception as e:
+        logger.warning(f"Share pending avatar error: {e}", exc_info=True)
+
+    return result
@@ -18,16 +18,18 @@
 
 import logging
 from json import dumps
+from time import time
 from typing import List, Union
 
-from PIL.Image import Image
 from pyrogram import Client
 
 from .. import glovar
 from .decorators import threaded
-from .etc import code_block, thread
+from .etc import code_block, delay
 from .file import crypt_file, data_to_file, delete_file, get_new_path
-from .telegram import send_document, send_message
+from .pool import submit
+from .regex import merge_count
+from .telegram import read_history, read_mention, send_document, send_message
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -53,6 +55,53 @@ def format_data(sender: str, receivers: List[str], action: str, action_type: str
     return result
 
 
+def mark_read(client: Client, cid: int, mid: int, action: str) -> bool:
+    # Mark a channel as read, a burst of calls is collapsed into one read call per interval
+    result = False
+
+    try:
+        key = (action, cid)
+
+        with glovar.locks["read"]:
+            pending = key in glovar.read_ids
+            glovar.read_ids[key] = max(mid, glovar.read_ids.get(key, 0))
+
+            if pending:
+                return True
+
+            wait = glovar.read_times.get(key, 0) + glovar.time_read - time()
+
+        if wait > 0:
+            result = delay(wait, submit, ["network", read_channel, (client, cid, action)])
+        else:
+            result = submit("network", read_channel, (client, cid, action))
+    except Exception as e:
+        logger.warning(f"Mark read error: {e}", exc_info=True)
+
+    return result
+
+
+def read_channel(client: Client, cid: int, action: str) -> bool:
+    # Send the pending read call of a channel
+    result = False
+
+    try:
+        key = (action, cid)
+
+        with glovar.locks["read"]:
+            mid = glovar.read_ids.pop(key, 0)
+            glovar.read_times[key] = time()
+
+        if action == "mention":
+            result = read_mention(client, cid)
+        else:
+            result = read_history(client, cid, mid)
+    except Exception as e:
+        logger.warning(f"Read channel error: {e}", exc_info=True)
+
+    return result
+
+
 @threaded()
 def send_help(client: Client, cid: int, text: str, mid: int = None) -> bool:
     # Request HIDE to help to send a text in a chat
@@ -129,7 +178,7 @@ def share_data(client: Client, receivers: List[str], action: str, action_type: s
 
         # Delete the tmp file
         for f in {file, file_path}:
-            f.startswith("tmp/") and thread(delete_file, (f,))
+            f.startswith("tmp/") and submit("clean", delete_file, (f,))
 
         result = bool(result)
     except Exception as e:
@@ -151,24 +200,33 @@ def share_data_failed() -> bool:
 
 
 def share_regex_count(client: Client, word_type: str) -> bool:
-    # Use this function to share regex count to REGEX
+    # Use this function to share regex count to REGEX, should be called with the regex lock
     result = False
 
     try:
+        # Include the pending hits
+        merge_count(word_type)
+
         if not glovar.regex.get(word_type):
             return False
 
         if not eval(f"glovar.{word_type}_words"):
             return False
 
-        file = data_to_file(eval(f"glovar.{word_type}_words"))
+        # Pickle the counts before they are reset
+        file = data_to_file(eval(f"glovar.{word_type}_words"), True)
+
+        if not file:
+            return False
+
         result = share_data(
             client=client,
             receivers=["REGEX"],
             action="regex",
             action_type="count",
             data=f"{word_type}_words",
-            file=file
+            file=file,
+            encrypt=False
         )
     except Exception as e:
         logger.warning(f"Share regex update error: {e}", exc_info=True)
@@ -176,12 +234,11 @@ def share_regex_count(client: Client, word_type: str) -> bool:
     return result
 
 
-def share_user_avatar(client: Client, gid: int, uid: int, mid: int, image: Image) -> bool:
-    # Share user's avatar to NOSPAM
+def share_user_avatar(client: Client, gid: int, uid: int, mid: int, file: str) -> bool:
+    # Share user's avatar to NOSPAM, the file is the encoded image
     result = False
 
     try:
-        file = data_to_file(image)
         result = share_data(
             client=client,
             receivers=["NOSPAM"],
@@ -198,3 +255,26 @@ def share_user_avatar(client: Client, gid: int, uid: int, mid: int, image: Image
         logger.warning(f"Share user avatar error: {e}", exc_info=True)
 
     return result
+
+
+def share_user_avatar_reference(client: Client, gid: int, uid: int, mid: int, same_id: int) -> bool:
+    # Share a reference to the same avatar of another user to NOSPAM
+    result = False
+
+    try:
+        result = share_data(
+            client=client,
+            receivers=["NOSPAM"],
+            action="update",
+            action_type="avatar",
+            data={
+                "group_id": gid,
+                "user_id": uid,
+                "message_id": mid,
+                "same_id": same_id
+            }
+        )
+    except Exception as e:
+        logger.warning(f"Share user avatar reference error: {e}", exc_info=True)
+
+    return result
@@ -21,7 +21,8 @@ from functools import wraps
 
 from pyrogram.errors import FloodWait
 
-from .etc import thread, wait_flood
+from .etc import wait_flood
+from .pool import submit
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -46,11 +47,11 @@ def retry(func):
     return wrapper
 
 
-def threaded(daemon: bool = True):
-    # Run with thread
+def threaded(pool: str = "network"):
+    # Run in a worker pool
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            return thread(func, args, kwargs, daemon)
+            return submit(pool, func, args, kwargs)
         return wrapper
     return decorator
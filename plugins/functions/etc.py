@@ -22,7 +22,7 @@ from html import escape
 from random import choice, uniform
 from re import sub
 from string import ascii_letters, digits
-from threading import Thread, Timer
+from threading import Timer
 from time import localtime, sleep, strftime, time
 from typing import Any, Callable, Optional, Union
 from unicodedata import normalize
@@ -41,6 +41,22 @@ logger = logging.getLogger(__name__)
 converter = OpenCC(config="t2s.json")
 
 
+def clean_text(text: str, printable: bool = False) -> str:
+    # Remove the invalid characters from the text, or only the non-printable ones
+    result = ""
+
+    try:
+        if not text:
+            return ""
+
+        pattern = glovar.nonprintable_pattern if printable else glovar.invalid_pattern
+        result = pattern.sub("", text)
+    except Exception as e:
+        logger.warning(f"Clean text error: {e}", exc_info=True)
+
+    return result
+
+
 def code(text: Any) -> str:
     # Get a code text
     result = ""
@@ -75,6 +91,30 @@ def code_block(text: Any) -> str:
     return result
 
 
+def convert_text(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
+    # Convert the string without the cache
+    result = text
+
+    try:
+        if glovar.normalize and normal:
+            result = result.translate(glovar.special_table)
+
+            result = normalize("NFKC", result)
+
+        if glovar.normalize and normal and "Hans" in glovar.lang:
+            result = converter.convert(result)
+
+        if printable:
+            result = clean_text(result, True)
+
+        if pure:
+            result = sub(r"""[^\da-zA-Z一-龥.,:'"?!~;()。，？！～@“”]""", "", result)
+    except Exception as e:
+        logger.warning(f"Convert text error: {e}", exc_info=True)
+
+    return result
+
+
 def crypt_str(operation: str, text: str, key: bytes) -> str:
     # Encrypt or decrypt a string
     result = ""
@@ -266,40 +306,25 @@ def t2t(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
         if not result:
             return ""
 
-        if glovar.normalize and normal:
-            for special in ["spc", "spe"]:
-                result = "".join(eval(f"glovar.{special}_dict").get(t, t) for t in result)
-
-            result = normalize("NFKC", result)
+        # Only the normalization is expensive enough to be cached
+        if not glovar.normalize or not normal or len(text) > glovar.text_length:
+            return convert_text(text, normal, printable, pure)
 
-        if glovar.normalize and normal and "Hans" in glovar.lang:
-            result = converter.convert(result)
+        key = (text, printable, pure)
+        generation = glovar.text_cache.generation
+        result = glovar.text_cache.get(key)
 
-        if printable:
-            result = "".join(t for t in result if t.isprintable() or t in {"\n", "\r", "\t"})
+        if result is not None:
+            return result
 
-        if pure:
-            result = sub(r"""[^\da-zA-Z一-龥.,:'"?!~;()。，？！～@“”]""", "", result)
+        result = convert_text(text, normal, printable, pure)
+        glovar.text_cache.put(key, result, generation)
     except Exception as e:
         logger.warning(f"T2T error: {e}", exc_info=True)
 
     return result
 
 
-def thread(target: Callable, args: tuple, kwargs: dict = None, daemon: bool = True) -> bool:
-    # Call a function using thread
-    result = False
-
-    try:
-        t = Thread(target=target, args=args, kwargs=kwargs, daemon=daemon)
-        t.daemon = daemon
-        result = t.start() or True
-    except Exception as e:
-        logger.warning(f"Thread error: {e}", exc_info=True)
-
-    return result
-
-
 def wait_flood(e: FloodWait) -> bool:
     # Wait flood secs
     result = False
@@ -17,17 +17,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from os import remove
-from os.path import exists
-from pickle import dump
-from shutil import copyfile
-from typing import Any
-
-from pyAesCrypt import decryptFile, encryptFile
+from io import BytesIO
+from os import fsync, remove, replace
+from os.path import exists, getsize
+from pickle import dump, dumps, load
+from tempfile import SpooledTemporaryFile
+from typing import Any, List
+
+from pyAesCrypt import decryptFile, decryptStream, encryptFile, encryptStream
 from pyrogram import Client
 
 from .. import glovar
-from .decorators import threaded
 from .etc import random_str
 from .telegram import download_media
 
@@ -35,6 +35,23 @@ from .telegram import download_media
 logger = logging.getLogger(__name__)
 
 
+def blob_to_file(blob: bytes) -> str:
+    # Save pickled data to an encrypted file in tmp directory
+    result = ""
+
+    try:
+        file_path = get_new_path()
+
+        with open(file_path, "wb") as f:
+            encryptStream(BytesIO(blob), f, glovar.password, 64 * 1024)
+
+        result = file_path
+    except Exception as e:
+        logger.warning(f"Blob to file error: {e}", exc_info=True)
+
+    return result
+
+
 def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     # Encrypt or decrypt a file
     result = False
@@ -57,15 +74,24 @@ def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     return result
 
 
-def data_to_file(data: Any) -> str:
-    # Save data to a file in tmp directory
+def data_to_file(data: Any, encrypt: bool = False) -> str:
+    # Save data to a file in tmp directory, the encrypted file is written without a plain copy on the disk
     result = ""
 
     try:
         file_path = get_new_path()
 
-        with open(file_path, "wb") as f:
-            dump(data, f)
+        if not encrypt:
+            with open(file_path, "wb") as f:
+                dump(data, f)
+
+            return file_path
+
+        # Small data is pickled in memory, large data spills over to tmp directory
+        with SpooledTemporaryFile(glovar.spool_size, dir="tmp") as plain, open(file_path, "wb") as f:
+            dump(data, plain)
+            plain.seek(0)
+            encryptStream(plain, f, glovar.password, 64 * 1024)
 
         result = file_path
     except Exception as e:
@@ -122,20 +148,172 @@ def get_new_path(extension: str = "", prefix: str = "") -> str:
     return result
 
 
-@threaded(daemon=False)
+def discard_journal(file: str) -> bool:
+    # Drop the pending mutations of a global variable, when all of its data is replaced
+    result = False
+
+    try:
+        with glovar.locks["file"]:
+            glovar.journals.pop(file, None)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Discard journal error: {e}", exc_info=True)
+
+    return result
+
+
+def dump_data(file: str) -> bytes:
+    # Pickle a global variable, hold the lock shards that guard its mutations while it is walked
+    if file == "deleted_ids":
+        locks = glovar.group_locks
+    elif file == "user_ids":
+        locks = glovar.group_locks + glovar.user_locks
+    else:
+        locks = []
+
+    for lock in locks:
+        lock.acquire()
+
+    try:
+        return dumps(getattr(glovar, file))
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+def file_to_data(path: str, decrypt: bool = True) -> Any:
+    # Load data from a file, the encrypted file is decrypted without a plain copy on the disk
+    result = None
+
+    try:
+        if not decrypt:
+            with open(path, "rb") as f:
+                return load(f)
+
+        with open(path, "rb") as f, SpooledTemporaryFile(glovar.spool_size, dir="tmp") as plain:
+            decryptStream(f, plain, glovar.password, 64 * 1024, getsize(path))
+            plain.seek(0)
+            result = load(plain)
+    except Exception as e:
+        logger.warning(f"File to data error: {e}", exc_info=True)
+
+    return result
+
+
+def flush_files() -> bool:
+    # Write all the marked global variables to files, many saves of the same file become one write
+    result = False
+
+    try:
+        with glovar.locks["file"]:
+            files = set(glovar.dirty_files)
+            glovar.dirty_files.clear()
+            journals = {file: glovar.journals.pop(file) for file in list(glovar.journals)}
+
+        # The journals must be written before the snapshots
+        for file in journals:
+            if not save_journal(file, journals[file]):
+                files.add(file)
+            elif getsize(f"data/{file}.log") > glovar.journal_size:
+                files.add(file)
+
+        for file in files:
+            save_file(file) or save(file)
+
+        glovar.avatar_cache.save()
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Flush files error: {e}", exc_info=True)
+
+    return result
+
+
+def journal(file: str, op: tuple) -> bool:
+    # Record a mutation of a global variable, to be appended to its journal by the next flush
+    result = False
+
+    try:
+        with glovar.locks["file"]:
+            glovar.journals.setdefault(file, []).append(op)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Journal error: {e}", exc_info=True)
+
+    return result
+
+
 def save(file: str) -> bool:
-    # Save a global variable to a file
+    # Mark a global variable to be saved by the next flush
+    result = False
+
+    try:
+        with glovar.locks["file"]:
+            glovar.dirty_files.add(file)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Save error: {e}", exc_info=True)
+
+    return result
+
+
+def save_file(file: str) -> bool:
+    # Save a global variable to a file, keep the previous file as the backup
     result = False
 
     try:
         if not glovar:
             return False
 
-        with open(f"data/.{file}", "wb") as f:
-            dump(eval(f"glovar.{file}"), f)
+        # The users are written to the tables on each mutation
+        if glovar.database and file == "user_ids":
+            return True
+
+        # Serialize in memory first, the data is locked only while it is pickled
+        data = dump_data(file)
+
+        if glovar.database:
+            glovar.database.save_blob(file, data)
+            return True
 
-        result = copyfile(f"data/.{file}", f"data/{file}") or True
+        with open(f"data/{file}.tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+
+        exists(f"data/{file}") and replace(f"data/{file}", f"data/.{file}")
+        replace(f"data/{file}.tmp", f"data/{file}")
+
+        # The snapshot includes all the mutations in the journal
+        exists(f"data/{file}.log") and remove(f"data/{file}.log")
+
+        result = True
     except Exception as e:
-        logger.warning(f"Save error: {e}", exc_info=True)
+        logger.warning(f"Save file {file} error: {e}", exc_info=True)
+
+    return result
+
+
+def save_journal(file: str, ops: List[tuple]) -> bool:
+    # Append the mutations to the journal of a global variable
+    result = False
+
+    try:
+        if not ops:
+            return True
+
+        with open(f"data/{file}.log", "ab") as f:
+            for op in ops:
+                dump(op, f)
+
+            f.flush()
+            fsync(f.fileno())
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Save journal {file} error: {e}", exc_info=True)
 
     return result
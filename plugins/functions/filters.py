@@ -17,18 +17,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import re
-from copy import deepcopy
-from string import ascii_lowercase, punctuation
-from typing import Match, Optional, Union
+from typing import Match, Optional, Set, Union
 
 from pyrogram import CallbackQuery, Client, Filters, Message, User
-from zhon.hanzi import punctuation as punctuation_zh
 
 from .. import glovar
 from .etc import get_full_name, get_now, get_text, t2t
-from .file import save
-from .ids import init_group_id
+from .ids import get_user_score, init_group_id
+from .regex import TextContext, count_word, get_context, get_engine, get_scanner
 from .telegram import get_user_full
 
 # Enable logging
@@ -297,79 +293,90 @@ def detect_nospam(client: Client, gid: int, user: User) -> bool:
     return result
 
 
-def is_ad_text(text: str, ocr: bool, matched: str = "") -> str:
-    # Check if the text is ad text
-    result = ""
+def get_ad_categories(text: Union[str, TextContext], ocr: bool, limit: int = 0) -> Set[str]:
+    # Get the ad categories that the text hit, scan the text only once
+    result = set()
 
     try:
-        if not text:
-            return ""
+        context = get_context(text)
 
-        for c in ascii_lowercase:
-            if c == matched:
-                continue
+        if not context.texts:
+            return set()
 
-            if not is_regex_text(f"ad{c}", text, ocr):
-                continue
+        # A scan is complete if it was not limited or did not reach the limit
+        scanned, found = context.ads.get(ocr, (-1, set()))
 
-            result = c
-            break
+        if scanned == 0 or len(found) < scanned or (limit and scanned >= limit):
+            return set(found)
+
+        scanner = get_scanner()
+
+        if not scanner:
+            return set()
+
+        hits = scanner.scan(context.texts, ocr, limit)
+
+        for c in hits:
+            count_word(f"ad{c}", hits[c])
+
+        result = set(hits)
+        context.ads[ocr] = (limit, result)
     except Exception as e:
-        logger.warning(f"Is ad text error: {e}", exc_info=True)
+        logger.warning(f"Get ad categories error: {e}", exc_info=True)
 
     return result
 
 
-def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
+def is_ban_text(text: Union[str, TextContext], ocr: bool, message: Message = None) -> bool:
     # Check if the text is ban text
     result = False
 
     try:
-        if is_regex_text("ban", text, ocr):
+        context = get_context(text)
+
+        if is_regex_text("ban", context, ocr):
             return True
 
         # ad + con
-        ad = is_regex_text("ad", text, ocr)
-        con = is_con_text(text, ocr)
+        ad = is_regex_text("ad", context, ocr)
+        con = is_con_text(context, ocr)
 
         if ad and con:
             return True
 
         # emoji + con
-        emoji = is_emoji("ad", text, message)
+        emoji = is_emoji("ad", context.text, message)
 
         if emoji and con:
             return True
 
         # ad_ + con
-        ad = is_ad_text(text, ocr)
+        ads = get_ad_categories(context, ocr, 2)
 
-        if ad and con:
+        if ads and con:
             return True
 
         # ad_ + emoji
-        if ad and emoji:
+        if ads and emoji:
             return True
 
         # ad_ + ad_
-        if not ad:
-            return False
-
-        ad = is_ad_text(text, ocr, ad)
-        result = bool(ad)
+        result = len(ads) > 1
     except Exception as e:
         logger.warning(f"Is ban text error: {e}", exc_info=True)
 
     return result
 
 
-def is_bio_text(text: str) -> bool:
+def is_bio_text(text: Union[str, TextContext]) -> bool:
     # Check if the text is bio text
     result = False
 
     try:
-        if (is_regex_text("bio", text)
-                or is_ban_text(text, False)):
+        context = get_context(text)
+
+        if (is_regex_text("bio", context)
+                or is_ban_text(context, False)):
             return True
     except Exception as e:
         logger.warning(f"Is bio text error: {e}", exc_info=True)
@@ -408,22 +415,23 @@ def is_class_e_user(user: Union[int, User]) -> bool:
         if uid in glovar.bot_ids:
             return True
 
-        group_list = list(glovar.trust_ids)
-        result = any(uid in glovar.trust_ids.get(gid, set()) for gid in group_list)
+        result = uid in glovar.trusted_ids
     except Exception as e:
         logger.warning(f"Is class e user error: {e}", exc_info=True)
 
     return result
 
 
-def is_con_text(text: str, ocr: bool) -> bool:
+def is_con_text(text: Union[str, TextContext], ocr: bool) -> bool:
     # Check if the text is con text
     result = False
 
     try:
-        if (is_regex_text("con", text, ocr)
-                or is_regex_text("iml", text, ocr)
-                or is_regex_text("pho", text, ocr)):
+        context = get_context(text)
+
+        if (is_regex_text("con", context, ocr)
+                or is_regex_text("iml", context, ocr)
+                or is_regex_text("pho", context, ocr)):
             return True
     except Exception as e:
         logger.warning(f"Is con text error: {e}", exc_info=True)
@@ -436,7 +444,7 @@ def is_declared_message_id(gid: int, mid: int) -> bool:
     result = False
 
     try:
-        result = mid in glovar.declared_message_ids.get(gid, set())
+        result = mid in glovar.declared_message_ids.get(gid, ())
     except Exception as e:
         logger.warning(f"Is declared message id error: {e}", exc_info=True)
 
@@ -451,16 +459,7 @@ def is_emoji(the_type: str, text: str, message: Message = None) -> bool:
         if message:
             text = get_text(message)
 
-        emoji_dict = {}
-        emoji_set = {emoji for emoji in glovar.emoji_set if emoji in text and emoji not in glovar.emoji_protect}
-        emoji_old_set = deepcopy(emoji_set)
-
-        for emoji in emoji_old_set:
-            if any(emoji in emoji_old and emoji != emoji_old for emoji_old in emoji_old_set):
-                emoji_set.discard(emoji)
-
-        for emoji in emoji_set:
-            emoji_dict[emoji] = text.count(emoji)
+        emoji_dict = glovar.emoji_trie.scan(text, glovar.emoji_protect)
 
         # Check ad
         if the_type == "ad":
@@ -501,12 +500,7 @@ def is_high_score_user(user: Union[int, User], high: bool = True) -> float:
         else:
             uid = user.id
 
-        user_status = glovar.user_ids.get(uid, {})
-
-        if not user_status:
-            return 0.0
-
-        score = sum(user_status["score"].values())
+        score = get_user_score(uid)
 
         if not high:
             return score
@@ -519,14 +513,16 @@ def is_high_score_user(user: Union[int, User], high: bool = True) -> float:
     return result
 
 
-def is_nm_text(text: str) -> bool:
+def is_nm_text(text: Union[str, TextContext]) -> bool:
     # Check if the text is nm text
     result = False
 
     try:
-        if (is_regex_text("nm", text)
-                or is_regex_text("bio", text)
-                or is_ban_text(text, False)):
+        context = get_context(text)
+
+        if (is_regex_text("nm", context)
+                or is_regex_text("bio", context)
+                or is_ban_text(context, False)):
             return True
     except Exception as e:
         logger.warning(f"Is nm text error: {e}", exc_info=True)
@@ -534,43 +530,36 @@ def is_nm_text(text: str) -> bool:
     return result
 
 
-def is_regex_text(word_type: str, text: str, ocr: bool = False, again: bool = False) -> Optional[Match]:
+def is_regex_text(word_type: str, text: Union[str, TextContext], ocr: bool = False) -> Optional[Match]:
     # Check if the text hit the regex rules
     result = None
 
     try:
-        if text:
-            if not again:
-                text = re.sub(r"\s{2,}", " ", text)
-            elif " " in text:
-                text = re.sub(r"\s", "", text)
-            else:
-                return None
-        else:
+        context = get_context(text)
+
+        if not context.texts:
             return None
 
-        with glovar.locks["regex"]:
-            words = list(eval(f"glovar.{word_type}_words"))
+        # Each rule set is evaluated only once for the same text
+        key = (word_type, ocr)
 
-        for word in words:
-            if ocr and "(?# nocr)" in word:
-                continue
+        if key in context.hits:
+            return context.hits[key]
 
-            result = re.search(word, text, re.I | re.S | re.M)
+        engine = get_engine(word_type)
 
-            # Count and return
-            if not result:
-                continue
+        if not engine:
+            return None
 
-            count = eval(f"glovar.{word_type}_words").get(word, 0)
-            count += 1
-            eval(f"glovar.{word_type}_words")[word] = count
-            save(f"{word_type}_words")
+        for variant in context.texts:
+            word, result = engine.search(variant, ocr)
 
-            return result
+            # Count and return
+            if result:
+                count_word(word_type, word)
+                break
 
-        # Try again
-        return is_regex_text(word_type, text, ocr, True)
+        context.hits[key] = result
     except Exception as e:
         logger.warning(f"Is regex text error: {e}", exc_info=True)
 
@@ -597,27 +586,3 @@ def is_watch_user(user: Union[int, User], the_type: str, now: int = 0) -> bool:
         logger.warning(f"Is watch user error: {e}", exc_info=True)
 
     return result
-
-
-def is_valid_character(c: str) -> bool:
-    # Check if the character is valid
-    result = False
-
-    try:
-        if not c.isprintable():
-            return False
-
-        if c in punctuation:
-            return False
-
-        if c in punctuation_zh:
-            return False
-
-        if c in glovar.emoji_set:
-            return False
-
-        result = True
-    except Exception as e:
-        logger.warning(f"Is valid character error: {e}", exc_info=True)
-
-    return result
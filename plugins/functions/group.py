@@ -22,8 +22,9 @@ from typing import List
 from pyrogram import ChatMember, Client
 
 from .. import glovar
-from .etc import thread
 from .file import save
+from .ids import update_trust_ids
+from .pool import submit
 from .telegram import leave_chat
 
 # Enable logging
@@ -37,7 +38,7 @@ def leave_group(client: Client, gid: int) -> bool:
     try:
         glovar.left_group_ids.add(gid)
         save("left_group_ids")
-        thread(leave_chat, (client, gid, True))
+        submit("network", leave_chat, (client, gid, True))
 
         glovar.admin_ids.pop(gid, set())
         save("admin_ids")
@@ -45,10 +46,11 @@ def leave_group(client: Client, gid: int) -> bool:
         glovar.deleted_ids.pop(gid, set())
         save("deleted_ids")
 
-        glovar.trust_ids.pop(gid, set())
-        save("trust_ids")
+        update_trust_ids(gid, None)
 
-        glovar.declared_message_ids.pop(gid, set())
+        glovar.declared_message_ids.pop(gid, None)
+
+        glovar.recent_message_ids.pop(gid, None)
 
         result = True
     except Exception as e:
@@ -72,10 +74,9 @@ def save_admins(gid: int, admin_members: List[ChatMember]) -> bool:
         save("admin_ids")
 
         # Trust list
-        glovar.trust_ids[gid] = {admin.user.id for admin in admin_members
-                                 if ((not admin.user.is_bot and not admin.user.is_deleted)
-                                     or admin.user.id in glovar.bot_ids)}
-        save("trust_ids")
+        update_trust_ids(gid, {admin.user.id for admin in admin_members
+                               if ((not admin.user.is_bot and not admin.user.is_deleted)
+                                   or admin.user.id in glovar.bot_ids)})
 
         result = True
     except Exception as e:
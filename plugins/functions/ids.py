@@ -17,15 +17,200 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from copy import deepcopy
+from contextlib import contextmanager
+from threading import RLock
+from typing import Iterator, List, Optional, Set
 
 from .. import glovar
-from .file import save
+from ..storage import DeletedIds, RecentIds, UserStatus, apply_user_op
+from .file import discard_journal, journal, save
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def add_user_message(uid: int, gid: int, mid: int) -> bool:
+    # Record a user's message in a group
+    result = False
+
+    try:
+        with get_group_lock(gid), get_user_lock(uid):
+            if not init_user_id(uid):
+                return False
+
+            # Remember the owner of the message, so its deletion can be subtracted from the count
+            if glovar.recent_message_ids.get(gid) is None:
+                glovar.recent_message_ids[gid] = RecentIds(glovar.recent_size)
+
+            # An edited message is not counted again
+            if mid in glovar.recent_message_ids[gid]:
+                return False
+
+            # The deletion may be received before the message
+            if mid in glovar.deleted_ids.get(gid, ()):
+                return False
+
+            glovar.recent_message_ids[gid].add(mid, uid)
+
+            result = update_user(("count", uid, gid, glovar.user_ids[uid].get_count(gid) + 1))
+    except Exception as e:
+        logger.warning(f"Add user message error: {e}", exc_info=True)
+
+    return result
+
+
+def clear_user_joins() -> bool:
+    # Clear all users' join status
+    result = False
+
+    try:
+        with lock_all():
+            if glovar.database:
+                glovar.user_ids.clear_joins()
+                return True
+
+            for uid in list(glovar.user_ids):
+                glovar.user_ids[uid].join = None
+
+            # The pending mutations happened before the clear, they must not be replayed on top of it
+            discard_journal("user_ids")
+            result = save("user_ids")
+    except Exception as e:
+        logger.warning(f"Clear user joins error: {e}", exc_info=True)
+
+    return result
+
+
+def clear_user_messages(uid: int) -> bool:
+    # Clear a user's message records
+    result = False
+
+    try:
+        if not glovar.user_ids.get(uid):
+            return False
+
+        result = update_user(("clean", uid))
+    except Exception as e:
+        logger.warning(f"Clear user messages error: {e}", exc_info=True)
+
+    return result
+
+
+def clear_users() -> bool:
+    # Clear all users
+    result = False
+
+    try:
+        with lock_all():
+            glovar.recent_message_ids = {}
+
+            if glovar.database:
+                glovar.user_ids.clear()
+                return True
+
+            glovar.user_ids = {}
+            discard_journal("user_ids")
+            result = save("user_ids")
+    except Exception as e:
+        logger.warning(f"Clear users error: {e}", exc_info=True)
+
+    return result
+
+
+def get_group_lock(gid: int) -> RLock:
+    # Get the lock shard of a group
+    return glovar.group_locks[hash(gid) % len(glovar.group_locks)]
+
+
+def get_new_users(since: int) -> List[int]:
+    # Get the users joined after the time
+    result = []
+
+    try:
+        if glovar.database:
+            return glovar.user_ids.get_new(since)
+
+        result = [uid for uid, status in list(glovar.user_ids.items())
+                  if any(time > since for time in status.get_joins().values())]
+    except Exception as e:
+        logger.warning(f"Get new users error: {e}", exc_info=True)
+
+    return result
+
+
+def get_user_avatar(uid: int) -> str:
+    # Get a user's recorded avatar
+    result = ""
+
+    try:
+        status = glovar.user_ids.get(uid)
+        result = status and status.avatar or ""
+    except Exception as e:
+        logger.warning(f"Get user avatar error: {e}", exc_info=True)
+
+    return result
+
+
+def get_user_join(uid: int, gid: int) -> int:
+    # Get a user's join time in a group
+    result = 0
+
+    try:
+        status = glovar.user_ids.get(uid)
+        result = status and status.get_join(gid) or 0
+    except Exception as e:
+        logger.warning(f"Get user join error: {e}", exc_info=True)
+
+    return result
+
+
+def get_user_lock(uid: int) -> RLock:
+    # Get the lock shard of a user
+    return glovar.user_locks[hash(uid) % len(glovar.user_locks)]
+
+
+def get_user_score(uid: int, project: str = "") -> float:
+    # Get a user's score of a project, or the total score
+    result = 0.0
+
+    try:
+        status = glovar.user_ids.get(uid)
+        result = status and status.get_score(project) or 0.0
+    except Exception as e:
+        logger.warning(f"Get user score error: {e}", exc_info=True)
+
+    return result
+
+
+def get_user_status(uid: int) -> Optional[UserStatus]:
+    # Get a copy of the user's status
+    result = None
+
+    try:
+        with get_user_lock(uid):
+            status = glovar.user_ids.get(uid)
+            result = status and status.copy()
+    except Exception as e:
+        logger.warning(f"Get user status error: {e}", exc_info=True)
+
+    return result
+
+
+def get_watching_count() -> int:
+    # Get the count of the users that have message records
+    result = 0
+
+    try:
+        if glovar.database:
+            return glovar.user_ids.get_watching_count()
+
+        result = len([uid for uid, status in list(glovar.user_ids.items()) if status.message])
+    except Exception as e:
+        logger.warning(f"Get watching count error: {e}", exc_info=True)
+
+    return result
+
+
 def init_group_id(gid: int) -> bool:
     # Init group data
     result = False
@@ -39,7 +224,7 @@ def init_group_id(gid: int) -> bool:
             save("admin_ids")
 
         if glovar.deleted_ids.get(gid) is None:
-            glovar.deleted_ids[gid] = set()
+            glovar.deleted_ids[gid] = DeletedIds()
             save("deleted_ids")
 
         if glovar.trust_ids.get(gid) is None:
@@ -47,7 +232,7 @@ def init_group_id(gid: int) -> bool:
             save("trust_ids")
 
         if glovar.declared_message_ids.get(gid) is None:
-            glovar.declared_message_ids[gid] = set()
+            glovar.declared_message_ids[gid] = RecentIds(glovar.limit_declared)
 
         result = True
     except Exception as e:
@@ -61,14 +246,198 @@ def init_user_id(uid: int) -> bool:
     result = False
 
     try:
-        if glovar.user_ids.get(uid) is not None:
-            return True
+        with get_user_lock(uid):
+            if glovar.user_ids.get(uid) is not None:
+                return True
+
+            result = update_user(("reset", uid))
+    except Exception as e:
+        logger.warning(f"Init user id {uid} error: {e}", exc_info=True)
+
+    return result
+
+
+@contextmanager
+def lock_all() -> Iterator[None]:
+    # Hold all the group and user lock shards, for the operations on all the users
+    locks = glovar.group_locks + glovar.user_locks
+
+    for lock in locks:
+        lock.acquire()
+
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+def remove_user_join(uid: int, gid: int) -> bool:
+    # Remove a user's join status in a group
+    result = False
+
+    try:
+        with get_user_lock(uid):
+            if not glovar.user_ids.get(uid):
+                return False
+
+            result = update_user(("leave", uid, gid))
+    except Exception as e:
+        logger.warning(f"Remove user join error: {e}", exc_info=True)
+
+    return result
+
+
+def remove_user_message(gid: int, mid: int) -> bool:
+    # Subtract a deleted message from its owner's count
+    result = False
+
+    try:
+        with get_group_lock(gid):
+            recent = glovar.recent_message_ids.get(gid)
+            uid = recent and recent.pop(mid)
+
+            if not uid:
+                return False
+
+            with get_user_lock(uid):
+                status = glovar.user_ids.get(uid)
+                count = status and status.get_count(gid)
+
+                if not count:
+                    return False
+
+                result = update_user(("count", uid, gid, count - 1))
+    except Exception as e:
+        logger.warning(f"Remove user message error: {e}", exc_info=True)
+
+    return result
+
+
+def replace_users(user_ids: dict) -> bool:
+    # Replace all users, for the rollback
+    result = False
+
+    try:
+        with lock_all():
+            glovar.recent_message_ids = {}
+
+            if glovar.database:
+                glovar.user_ids.replace(user_ids)
+                return True
+
+            glovar.user_ids = user_ids
+            discard_journal("user_ids")
+            result = save("user_ids")
+    except Exception as e:
+        logger.warning(f"Replace users error: {e}", exc_info=True)
+
+    return result
+
+
+def reset_user(uid: int) -> bool:
+    # Reset a user's status
+    result = False
+
+    try:
+        result = update_user(("reset", uid))
+    except Exception as e:
+        logger.warning(f"Reset user error: {e}", exc_info=True)
+
+    return result
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+
+def set_user_avatar(uid: int, file_id: str) -> bool:
+    # Update a user's avatar
+    result = False
+
+    try:
+        with get_user_lock(uid):
+            if not init_user_id(uid):
+                return False
+
+            result = update_user(("avatar", uid, file_id))
+    except Exception as e:
+        logger.warning(f"Set user avatar error: {e}", exc_info=True)
+
+    return result
+
+
+def set_user_join(uid: int, gid: int, now: int) -> bool:
+    # Update a user's join time in a group
+    result = False
+
+    try:
+        with get_user_lock(uid):
+            if not init_user_id(uid):
+                return False
+
+            result = update_user(("join", uid, gid, now))
+    except Exception as e:
+        logger.warning(f"Set user join error: {e}", exc_info=True)
+
+    return result
+
+
+def set_user_score(uid: int, project: str, score: float) -> bool:
+    # Update a user's score of a project
+    result = False
+
+    try:
+        with get_user_lock(uid):
+            if not init_user_id(uid):
+                return False
+
+            result = update_user(("score", uid, project, score))
+    except Exception as e:
+        logger.warning(f"Set user score error: {e}", exc_info=True)
+
+    return result
+
+
+def update_trust_ids(gid: int, uids: Optional[Set[int]]) -> bool:
+    # Update the trusted users of a group and the trust index, remove the group if the users are None
+    result = False
+
+    try:
+        with glovar.locks["trust"]:
+            # Build the index before the change
+            index = glovar.trusted_ids
+            old_ids = glovar.trust_ids.get(gid, set())
+            new_ids = uids or set()
+
+            if uids is None:
+                glovar.trust_ids.pop(gid, None)
+            else:
+                glovar.trust_ids[gid] = uids
+
+            for uid in new_ids - old_ids:
+                index[uid] += 1
+
+            for uid in old_ids - new_ids:
+                index[uid] -= 1
+                index[uid] <= 0 and index.pop(uid, 0)
+
+            save("trust_ids")
 
         result = True
     except Exception as e:
-        logger.warning(f"Init user id {uid} error: {e}", exc_info=True)
+        logger.warning(f"Update trust ids error: {e}", exc_info=True)
+
+    return result
+
+
+def update_user(op: tuple) -> bool:
+    # Apply a mutation of a user's status to the storage
+    result = False
+
+    try:
+        with get_user_lock(op[1]):
+            if glovar.database:
+                return glovar.user_ids.apply(op)
+
+            result = apply_user_op(glovar.user_ids, op) and journal("user_ids", op)
+    except Exception as e:
+        logger.warning(f"Update user error: {e}", exc_info=True)
 
     return result
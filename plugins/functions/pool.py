@@ -0,0 +1,149 @@
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from queue import Full, Queue
+from threading import Thread, current_thread
+from time import time
+from typing import Callable, Dict, Tuple
+
+from .. import glovar
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    # A named pool of daemon worker threads with a bounded task queue
+    __slots__ = ("name", "queue", "threads")
+
+    def __init__(self, name: str, workers: int, size: int):
+        self.name = name
+        self.queue: Queue = Queue(size)
+        self.threads = [Thread(target=self.work, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+
+        for t in self.threads:
+            t.start()
+
+    def shutdown(self, timeout: float) -> bool:
+        # Stop the workers after the queued tasks are done, return False if some workers are still running
+        deadline = time() + timeout
+
+        try:
+            for _ in self.threads:
+                self.queue.put(None, timeout=max(deadline - time(), 0.1))
+        except Full:
+            return False
+
+        for t in self.threads:
+            t.join(max(deadline - time(), 0))
+
+        return not any(t.is_alive() for t in self.threads)
+
+    def run(self, target: Callable, args: tuple, kwargs: dict) -> None:
+        # Run a task
+        try:
+            target(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Pool {self.name} task error: {e}", exc_info=True)
+
+    def submit(self, target: Callable, args: tuple = (), kwargs: dict = None, block: bool = True) -> bool:
+        # Add a task, wait for a free slot if the queue is full, or return False without blocking
+        # A task submitted by a worker of the pool runs in place, a worker never waits for its own queue
+        if current_thread() in self.threads:
+            self.run(target, args, kwargs or {})
+            return True
+
+        try:
+            self.queue.put((target, args, kwargs or {}), block=block)
+        except Full:
+            return False
+
+        return True
+
+    def work(self) -> None:
+        # Run the tasks until the stop signal
+        while True:
+            task = self.queue.get()
+
+            try:
+                if task is None:
+                    return
+
+                self.run(*task)
+            finally:
+                self.queue.task_done()
+
+
+def get_pool(name: str) -> WorkerPool:
+    # Get a worker pool, start it on first use
+    result = glovar.pools.get(name)
+
+    if result is not None:
+        return result
+
+    with glovar.locks["pool"]:
+        result = glovar.pools.get(name)
+
+        if result is None:
+            workers, size = glovar.pool_sizes[name]
+            result = WorkerPool(name, workers, size)
+            glovar.pools[name] = result
+
+    return result
+
+
+def get_pool_depths() -> Dict[str, Tuple[int, int]]:
+    # Get the count of the queued tasks and the queue size of each started pool
+    result = {}
+
+    try:
+        for name, pool in list(glovar.pools.items()):
+            result[name] = (pool.queue.qsize(), pool.queue.maxsize)
+    except Exception as e:
+        logger.warning(f"Get pool depths error: {e}", exc_info=True)
+
+    return result
+
+
+def shutdown_pools(timeout: float = 30) -> bool:
+    # Finish the queued tasks of all the pools
+    result = False
+
+    try:
+        with glovar.locks["pool"]:
+            pools = list(glovar.pools.values())
+
+        deadline = time() + timeout
+        result = all([pool.shutdown(max(deadline - time(), 0)) for pool in pools])
+    except Exception as e:
+        logger.warning(f"Shutdown pools error: {e}", exc_info=True)
+
+    return result
+
+
+def submit(name: str, target: Callable, args: tuple = (), kwargs: dict = None, block: bool = True) -> bool:
+    # Run a function in a worker pool
+    result = False
+
+    try:
+        result = get_pool(name).submit(target, args, kwargs, block)
+    except Exception as e:
+        logger.warning(f"Submit to pool {name} error: {e}", exc_info=True)
+
+    return result
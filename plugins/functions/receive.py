@@ -17,8 +17,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import pickle
-from copy import deepcopy
 from json import loads
 from subprocess import run, PIPE
 from typing import Any
@@ -26,13 +24,17 @@ from typing import Any
 from pyrogram import Client, Message
 
 from .. import glovar
+from ..storage import convert_data, get_special_dict, get_special_table, get_trusted_ids
 from .channel import send_help, share_data
-from .etc import code, crypt_str, general_link, get_int, get_readable_time, get_text, lang, mention_id, thread
-from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, save
+from .etc import code, crypt_str, general_link, get_int, get_readable_time, get_text, lang, mention_id
+from .file import data_to_file, delete_file, file_to_data, get_downloaded_path, save
 from .filters import is_high_score_user
-from .ids import init_group_id, init_user_id
+from .ids import clear_user_joins, clear_user_messages, clear_users, get_watching_count, init_group_id, init_user_id
+from .ids import remove_user_join, replace_users, reset_user, set_user_score
+from .pool import get_pool_depths, submit
+from .regex import update_engine, update_scanner
 from .timers import update_admins
-from .user import get_user, remove_new_users
+from .user import get_user
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -121,8 +123,6 @@ def receive_captcha_kicked_user(data: dict) -> bool:
     # Receive CAPTCHA kicked user
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         gid = data["group_id"]
@@ -136,14 +136,11 @@ def receive_captcha_kicked_user(data: dict) -> bool:
         if not glovar.user_ids.get(uid, {}):
             return True
 
-        glovar.user_ids[uid]["join"].pop(gid, 0)
-        save("user_ids")
+        remove_user_join(uid, gid)
 
         result = True
     except Exception as e:
         logger.warning(f"Receive captcha kicked user error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -152,8 +149,6 @@ def receive_captcha_kicked_users(client: Client, message: Message, data: int) ->
     # Receive CAPTCHA kicked users
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         gid = data
@@ -167,15 +162,11 @@ def receive_captcha_kicked_users(client: Client, message: Message, data: int) ->
 
         # Remove group status
         for uid in uids:
-            glovar.user_ids.get(uid, {}) and glovar.user_ids[uid]["join"].pop(gid, 0)
-
-        save("user_ids")
+            remove_user_join(uid, gid)
 
         result = True
     except Exception as e:
         logger.warning(f"Receive captcha kicked users error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -184,8 +175,6 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
     # Receive clear data command
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         aid = data["admin_id"]
@@ -210,11 +199,9 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
         # Clear user data
         elif data_type == "user":
             if the_type == "all":
-                glovar.user_ids = {}
+                clear_users()
             elif the_type == "new":
-                remove_new_users()
-
-            save("user_ids")
+                clear_user_joins()
 
         # Clear watch data
         elif data_type == "watch":
@@ -254,8 +241,6 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
         result = send_help(client, glovar.debug_channel_id, text)
     except Exception as e:
         logger.warning(f"Receive clear data: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -301,21 +286,8 @@ def receive_file_data(client: Client, message: Message, decrypt: bool = True) ->
         if not path:
             return None
 
-        if decrypt:
-            # Decrypt the file, save to the tmp directory
-            path_decrypted = get_new_path()
-            crypt_file("decrypt", path, path_decrypted)
-            path_final = path_decrypted
-        else:
-            # Read the file directly
-            path_decrypted = ""
-            path_final = path
-
-        with open(path_final, "rb") as f:
-            result = pickle.load(f)
-
-        for f in {path, path_decrypted}:
-            thread(delete_file, (f,))
+        result = file_to_data(path, decrypt)
+        submit("clean", delete_file, (path,))
     except Exception as e:
         logger.warning(f"Receive file error: {e}", exc_info=True)
 
@@ -326,8 +298,6 @@ def receive_flood_score(client: Client, message: Message) -> bool:
     # Receive flood users' score
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         users = receive_file_data(client, message)
 
@@ -337,15 +307,11 @@ def receive_flood_score(client: Client, message: Message) -> bool:
         user_list = [uid for uid in list(users) if init_user_id(uid)]
 
         for uid in user_list:
-            glovar.user_ids[uid]["score"]["captcha"] = users[uid]
-
-        save("user_ids")
+            set_user_score(uid, "captcha", users[uid])
 
         result = True
     except Exception as e:
         logger.warning(f"Receive flood score error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -378,8 +344,6 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
     # Receive regex
     result = False
 
-    glovar.locks["regex"].acquire()
-
     try:
         file_name = data
         word_type = file_name.split("_")[0]
@@ -387,11 +351,18 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
         if word_type not in glovar.regex:
             return False
 
+        # Download the file before taking the lock, the rule readers are not blocked by the download
         words_data = receive_file_data(client, message)
 
         if words_data is None:
             return False
+    except Exception as e:
+        logger.warning(f"Receive regex error: {e}", exc_info=True)
+        return False
 
+    glovar.locks["regex"].acquire()
+
+    try:
         pop_set = set(eval(f"glovar.{file_name}")) - set(words_data)
         new_set = set(words_data) - set(eval(f"glovar.{file_name}"))
 
@@ -403,27 +374,20 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
 
         save(file_name)
 
+        # Swap in the new rule engine, and the new ad scanner
+        update_engine(word_type)
+        len(word_type) == 3 and word_type.startswith("ad") and update_scanner()
+
         # Regenerate special characters dictionary if possible
         if file_name not in {"spc_words", "spe_words"}:
             return False
 
-        special = file_name.split("_")[0]
-        exec(f"glovar.{special}_dict = {{}}")
-
-        for rule in words_data:
-            # Check keys
-            if "[" not in rule:
-                continue
-
-            # Check value
-            if "?#" not in rule:
-                continue
+        # Build the new dictionary and table before swapping them in, the readers never see a partial one
+        setattr(glovar, f"{word_type}_dict", get_special_dict(words_data))
+        glovar.special_table = get_special_table(glovar.spc_dict, glovar.spe_dict)
 
-            keys = rule.split("]")[0][1:]
-            value = rule.split("?#")[1][1]
-
-            for k in keys:
-                eval(f"glovar.{special}_dict")[k] = value
+        # The cached texts were normalized with the old dictionary
+        glovar.text_cache.clear()
 
         result = True
     except Exception as e:
@@ -453,8 +417,7 @@ def receive_remove_bad(data: dict) -> bool:
             glovar.watch_ids["ban"].pop(the_id, {})
             glovar.watch_ids["delete"].pop(the_id, {})
             save("watch_ids")
-            glovar.user_ids[the_id] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            reset_user(the_id)
 
         save("bad_ids")
 
@@ -498,8 +461,6 @@ def receive_remove_score(data: int) -> bool:
     # Receive remove user's score
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         uid = data
@@ -507,14 +468,11 @@ def receive_remove_score(data: int) -> bool:
         if not glovar.user_ids.get(uid):
             return False
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+        reset_user(uid)
 
         result = True
     except Exception as e:
         logger.warning(f"Receive remove score error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -561,8 +519,7 @@ def receive_remove_white(data: int) -> bool:
         save("white_wait_ids")
 
         # User ids
-        glovar.user_ids[uid]["message"] = {}
-        save("user_ids")
+        clear_user_messages(uid)
 
         result = True
     except Exception as e:
@@ -586,8 +543,27 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
         if the_data is None:
             return False
 
-        exec(f"glovar.{the_type} = the_data")
-        save(the_type)
+        # Accept the data of the old format
+        the_data = convert_data(the_type, the_data, glovar.deleted_ids)
+
+        if the_type == "user_ids":
+            replace_users(the_data)
+        else:
+            exec(f"glovar.{the_type} = the_data")
+            save(the_type)
+
+        # Rebuild the trust index
+        if the_type == "trust_ids":
+            with glovar.locks["trust"]:
+                glovar.trusted_ids = get_trusted_ids(glovar.trust_ids)
+
+        # Rebuild the rule engine
+        if the_type.endswith("_words"):
+            word_type = the_type.split("_")[0]
+
+            with glovar.locks["regex"]:
+                update_engine(word_type)
+                len(word_type) == 3 and word_type.startswith("ad") and update_scanner()
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
@@ -607,25 +583,36 @@ def receive_status_ask(client: Client, data: dict) -> bool:
     # Receive status request
     result = False
 
-    glovar.locks["white"].acquire()
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         aid = data["admin_id"]
         mid = data["message_id"]
 
-        watching_users_count = len([uid for uid in glovar.user_ids if glovar.user_ids[uid].get("message", {})])
-        waiting_users_count = len(glovar.white_wait_ids)
-        white_users_count = len(glovar.white_ids)
+        watching_users_count = get_watching_count()
+
+        with glovar.locks["white"]:
+            waiting_users_count = len(glovar.white_wait_ids)
+            white_users_count = len(glovar.white_ids)
+
+        cache_hits = glovar.avatar_cache.hits
+        cache_total = cache_hits + glovar.avatar_cache.misses
+        depths = get_pool_depths()
+        text_hits = glovar.text_cache.hits
+        text_total = text_hits + glovar.text_cache.misses
 
         status = {
             lang("watching_users"): f"{watching_users_count} {lang('members')}",
             lang("waiting_users"): f"{waiting_users_count} {lang('members')}",
-            lang("white_users"): f"{white_users_count} {lang('members')}"
+            lang("white_users"): f"{white_users_count} {lang('members')}",
+            lang("avatar_cache"): f"{cache_hits} / {cache_total}",
+            lang("text_cache"): f"{text_hits} / {text_total}",
+            lang("task_queues"): ", ".join(f"{name} {depths[name][0]} / {depths[name][1]}" for name in sorted(depths))
         }
 
-        file = data_to_file(status)
+        file = data_to_file(status, True)
+
+        if not file:
+            return False
 
         result = share_data(
             client=client,
@@ -636,13 +623,11 @@ def receive_status_ask(client: Client, data: dict) -> bool:
                 "admin_id": aid,
                 "message_id": mid
             },
-            file=file
+            file=file,
+            encrypt=False
         )
     except Exception as e:
         logger.warning(f"Receive status ask error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
-        glovar.locks["white"].release()
 
     return result
 
@@ -668,8 +653,6 @@ def receive_user_score(client: Client, project: str, data: dict) -> bool:
     # Receive and update user's score
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         project = project.lower()
@@ -679,8 +662,7 @@ def receive_user_score(client: Client, project: str, data: dict) -> bool:
             return False
 
         score = data["score"]
-        glovar.user_ids[uid]["score"][project] = score
-        save("user_ids")
+        set_user_score(uid, project, score)
 
         if is_high_score_user(uid, False) <= 1.8:
             return True
@@ -698,8 +680,6 @@ def receive_user_score(client: Client, project: str, data: dict) -> bool:
         )
     except Exception as e:
         logger.warning(f"Receive user score error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
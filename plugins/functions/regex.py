@@ -0,0 +1,371 @@
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import re
+from collections import Counter
+from string import ascii_lowercase
+from threading import Lock
+from typing import Dict, FrozenSet, Iterable, List, Match, NamedTuple, Optional, Pattern, Set, Tuple, Union
+
+from .. import glovar
+from .file import save
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+class Rule(NamedTuple):
+    # A compiled regex rule
+    word: str
+    pattern: Pattern
+    nocr: bool
+
+
+class RuleEngine:
+    # Compiled regex rules of a word type
+    __slots__ = ("word_type", "rules")
+
+    def __init__(self, word_type: str, words: Iterable[str]):
+        self.word_type = word_type
+        self.rules = tuple(compile_rules(word_type, words))
+
+    def search(self, text: str, ocr: bool = False) -> Tuple[str, Optional[Match]]:
+        # Search the text with the rules, return the hit word and the match
+        for rule in self.rules:
+            if ocr and rule.nocr:
+                continue
+
+            result = rule.pattern.search(text)
+
+            if result:
+                return rule.word, result
+
+        return "", None
+
+
+class AdScanner:
+    # Combined matcher of all the ad letter rules
+    __slots__ = ("names", "singles", "patterns")
+
+    def __init__(self, engines: Dict[str, RuleEngine]):
+        # The named group of each combinable rule, and the rules can not be combined
+        self.names: Dict[str, Tuple[str, Rule]] = {}
+        self.singles: List[Tuple[str, Rule]] = []
+        self.patterns: Dict[Tuple[bool, FrozenSet[str]], Optional[Pattern]] = {}
+
+        for c in sorted(engines):
+            for i, rule in enumerate(engines[c].rules):
+                if is_combinable(rule):
+                    self.names[f"{c}_{i}"] = (c, rule)
+                else:
+                    self.singles.append((c, rule))
+
+        # Check the full alternation once, every pattern of its branches can be compiled then
+        try:
+            self.names and re.compile(self.get_alternation(False, frozenset()), re.I | re.S | re.M)
+        except re.error as e:
+            # Fall back to match the rules one by one
+            logger.warning(f"Combine ad rules error: {e}")
+            self.singles.extend(self.names.values())
+            self.names.clear()
+
+    def get_alternation(self, ocr: bool, excluded: FrozenSet[str]) -> str:
+        # Get the alternation of the categories that are not excluded
+        return "|".join(f"(?P<{name}>{rule.word})" for name, (c, rule) in self.names.items()
+                        if c not in excluded and not (ocr and rule.nocr))
+
+    def get_pattern(self, ocr: bool, excluded: FrozenSet[str]) -> Optional[Pattern]:
+        # Get the combined pattern of the categories that are not excluded
+        key = (ocr, excluded)
+
+        if key in self.patterns:
+            return self.patterns[key]
+
+        alternation = self.get_alternation(ocr, excluded)
+        result = alternation and re.compile(alternation, re.I | re.S | re.M) or None
+
+        len(self.patterns) >= 64 and self.patterns.clear()
+        self.patterns[key] = result
+
+        return result
+
+    def scan(self, texts: List[str], ocr: bool = False, limit: int = 0) -> Dict[str, str]:
+        # Scan the texts, return the matched categories and their hit words
+        result = {}
+
+        for text in texts:
+            found = True
+
+            # A category may be hidden by an overlapping match of another one, so scan again without the found ones
+            while found and (not limit or len(result) < limit):
+                found = False
+                pattern = self.get_pattern(ocr, frozenset(result))
+
+                if pattern is None:
+                    break
+
+                for match in pattern.finditer(text):
+                    c, rule = self.names[match.lastgroup]
+
+                    if c in result:
+                        continue
+
+                    result[c] = rule.word
+                    found = True
+
+        for c, rule in self.singles:
+            if limit and len(result) >= limit:
+                break
+
+            if c in result or (ocr and rule.nocr):
+                continue
+
+            if any(rule.pattern.search(text) for text in texts):
+                result[c] = rule.word
+
+        return result
+
+
+class RuleCounter:
+    # Sharded in-memory hit counter of the regex rules
+    __slots__ = ("shards",)
+
+    def __init__(self, size: int = 16):
+        self.shards: List[Tuple[Lock, Counter]] = [(Lock(), Counter()) for _ in range(size)]
+
+    def add(self, word_type: str, word: str) -> None:
+        # Count a hit, only the shard of the word is locked
+        lock, counter = self.shards[hash(word) % len(self.shards)]
+
+        with lock:
+            counter[(word_type, word)] += 1
+
+    def pop(self, word_type: str = "") -> Dict[str, Counter]:
+        # Take out the pending hits of a word type, or of all word types
+        result: Dict[str, Counter] = {}
+
+        for lock, counter in self.shards:
+            with lock:
+                keys = [key for key in counter if not word_type or key[0] == word_type]
+
+                for key in keys:
+                    result.setdefault(key[0], Counter())[key[1]] += counter.pop(key)
+
+        return result
+
+
+class TextContext:
+    # Analysis context of a text, memoize the normalized variants and the rule hits
+    __slots__ = ("text", "texts", "hits", "ads")
+
+    def __init__(self, text: str):
+        self.text = text or ""
+        self.texts = get_variants(self.text)
+        self.hits: Dict[Tuple[str, bool], Optional[Match]] = {}
+        self.ads: Dict[bool, Tuple[int, Set[str]]] = {}
+
+
+# Pending hit counts that have not been written to the word lists
+counter = RuleCounter()
+
+
+def compile_rules(word_type: str, words: Iterable[str]) -> List[Rule]:
+    # Compile regex rules
+    result = []
+
+    try:
+        for word in words:
+            try:
+                pattern = re.compile(word, re.I | re.S | re.M)
+            except re.error as e:
+                logger.warning(f"Compile {word_type} rule {word} error: {e}")
+                continue
+
+            result.append(Rule(word, pattern, "(?# nocr)" in word))
+    except Exception as e:
+        logger.warning(f"Compile rules error: {e}", exc_info=True)
+
+    return result
+
+
+def count_word(word_type: str, word: str) -> bool:
+    # Count a hit of the regex rule
+    result = False
+
+    try:
+        counter.add(word_type, word)
+        result = True
+    except Exception as e:
+        logger.warning(f"Count word error: {e}", exc_info=True)
+
+    return result
+
+
+def flush_count() -> bool:
+    # Write all the pending hit counts to the word lists
+    result = False
+
+    try:
+        with glovar.locks["regex"]:
+            for word_type in glovar.regex:
+                merge_count(word_type)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Flush count error: {e}", exc_info=True)
+
+    return result
+
+
+def get_context(text: Union[str, TextContext]) -> TextContext:
+    # Get the analysis context of a text
+    if isinstance(text, TextContext):
+        return text
+
+    return TextContext(text)
+
+
+def get_engine(word_type: str) -> Optional[RuleEngine]:
+    # Get the rule engine of a word type
+    result = glovar.regex_engines.get(word_type)
+
+    if result is not None:
+        return result
+
+    try:
+        with glovar.locks["regex"]:
+            result = glovar.regex_engines.get(word_type) or update_engine(word_type)
+    except Exception as e:
+        logger.warning(f"Get engine error: {e}", exc_info=True)
+
+    return result
+
+
+def get_scanner() -> Optional[AdScanner]:
+    # Get the combined scanner of the ad letter rules
+    result = glovar.ad_scanner
+
+    if result is not None:
+        return result
+
+    try:
+        with glovar.locks["regex"]:
+            result = glovar.ad_scanner or update_scanner()
+    except Exception as e:
+        logger.warning(f"Get scanner error: {e}", exc_info=True)
+
+    return result
+
+
+def get_variants(text: str) -> List[str]:
+    # Get the normalized variants of a text to be matched
+    result = []
+
+    try:
+        if not text:
+            return []
+
+        result.append(re.sub(r"\s{2,}", " ", text))
+
+        # Try again without spaces
+        " " in result[0] and result.append(re.sub(r"\s", "", result[0]))
+    except Exception as e:
+        logger.warning(f"Get variants error: {e}", exc_info=True)
+
+    return result
+
+
+def is_combinable(rule: Rule) -> bool:
+    # Check if the rule can be a branch of a combined alternation
+    result = False
+
+    try:
+        # Named groups may collide, backreferences and global flags do not survive the combination
+        if rule.pattern.groupindex:
+            return False
+
+        if re.search(r"\\\d|\(\?P=|\(\?[aiLmsux]+\)", rule.word):
+            return False
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Is combinable error: {e}", exc_info=True)
+
+    return result
+
+
+def merge_count(word_type: str) -> bool:
+    # Merge the pending hit counts of a word type, should be called with the regex lock
+    result = False
+
+    try:
+        counts = counter.pop(word_type).get(word_type)
+
+        if not counts:
+            return False
+
+        words = getattr(glovar, f"{word_type}_words")
+
+        # The rules may be removed by REGEX after the hits
+        for word in counts:
+            if word not in words:
+                continue
+
+            words[word] = words[word] + counts[word]
+
+        save(f"{word_type}_words")
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Merge count error: {e}", exc_info=True)
+
+    return result
+
+
+def update_engine(word_type: str) -> Optional[RuleEngine]:
+    # Rebuild the rule engine of a word type, should be called with the regex lock
+    result = None
+
+    try:
+        if word_type not in glovar.regex:
+            return None
+
+        words = list(getattr(glovar, f"{word_type}_words"))
+        result = RuleEngine(word_type, words)
+        glovar.regex_engines[word_type] = result
+    except Exception as e:
+        logger.warning(f"Update engine error: {e}", exc_info=True)
+
+    return result
+
+
+def update_scanner() -> Optional[AdScanner]:
+    # Rebuild the combined ad scanner, should be called with the regex lock
+    result = None
+
+    try:
+        engines = {c: glovar.regex_engines.get(f"ad{c}") or update_engine(f"ad{c}") for c in ascii_lowercase}
+        result = AdScanner({c: engines[c] for c in engines if engines[c]})
+
+        # Swap in the whole scanner, the readers never see a partial one
+        glovar.ad_scanner = result
+    except Exception as e:
+        logger.warning(f"Update scanner error: {e}", exc_info=True)
+
+    return result
@@ -174,12 +174,12 @@ def leave_chat(client: Client, cid: int, delete: bool = False) -> bool:
 
 
 @retry
-def read_history(client: Client, cid: int) -> bool:
-    # Mark messages in a chat as read
+def read_history(client: Client, cid: int, mid: int = 0) -> bool:
+    # Mark messages in a chat as read, up to the message id if it is given
     result = False
 
     try:
-        result = client.read_history(chat_id=cid) or True
+        result = client.read_history(chat_id=cid, max_id=mid) or True
     except FloodWait as e:
         raise e
     except Exception as e:
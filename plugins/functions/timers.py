@@ -17,21 +17,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from copy import deepcopy
 from random import randint
 from time import sleep
 
-from PIL import Image
 from pyrogram import Client
 from pyrogram.errors import ChannelInvalid, ChannelPrivate, FloodWait, PeerIdInvalid
 
 from .. import glovar
-from .channel import send_help, share_data, share_regex_count, share_user_avatar
+from .avatar import add_avatar_job
+from .channel import send_help, share_data, share_regex_count
 from .decorators import retry, threaded
-from .etc import code, delay, general_link, get_now, lang, thread
-from .file import data_to_file, delete_file, get_downloaded_path, save
+from .etc import code, delay, general_link, get_now, lang
+from .file import blob_to_file, data_to_file, dump_data, save
 from .filters import is_class_d_user, is_high_score_user, is_watch_user
 from .group import leave_group, save_admins
+from .ids import clear_user_messages, clear_users, get_new_users, get_user_score, get_user_status
 from .user import get_user
 from .telegram import get_admins, get_chat_member, get_members, update_online_status
 
@@ -39,7 +39,7 @@ from .telegram import get_admins, get_chat_member, get_members, update_online_st
 logger = logging.getLogger(__name__)
 
 
-@threaded()
+@threaded("timer")
 def backup_files(client: Client) -> bool:
     # Backup data files to BACKUP
     result = False
@@ -50,6 +50,15 @@ def backup_files(client: Client) -> bool:
             if not eval(f"glovar.{file}"):
                 continue
 
+            # Export the data in memory, the data file of user_ids does not include the mutations in its journal
+            if glovar.database and file == "user_ids":
+                file_path = data_to_file(glovar.user_ids.to_dict(), True)
+            else:
+                file_path = blob_to_file(dump_data(file))
+
+            if not file_path:
+                continue
+
             # Share
             share_data(
                 client=client,
@@ -57,7 +66,8 @@ def backup_files(client: Client) -> bool:
                 action="backup",
                 action_type="data",
                 data=file,
-                file=f"data/{file}"
+                file=file_path,
+                encrypt=False
             )
             sleep(5)
 
@@ -90,17 +100,18 @@ def interval_min_15(client: Client) -> bool:
         # Basic data
         now = get_now()
 
-        with glovar.locks["message"]:
-            user_ids = deepcopy(glovar.user_ids)
+        uids = get_new_users(now - glovar.time_new)
 
         # Check user's avatar
-        for uid in user_ids:
+        for uid in uids:
             # Do not check banned users
             if uid in glovar.bad_ids["users"]:
                 continue
 
+            user_status = get_user_status(uid)
+
             # Check new joined users
-            if not any(now - user_ids[uid]["join"][gid] < glovar.time_new for gid in user_ids[uid]["join"]):
+            if not user_status or not user_status.join:
                 continue
 
             # Get user
@@ -112,26 +123,15 @@ def interval_min_15(client: Client) -> bool:
 
             # Get avatar
             file_id = user.photo.big_file_id
-            file_ref = ""
-            old_id = user_ids[uid]["avatar"]
+            old_id = user_status.avatar
 
             if file_id == old_id:
                 continue
 
-            glovar.user_ids[uid]["avatar"] = file_id
-            save("user_ids")
-            image_path = get_downloaded_path(client, file_id, file_ref)
-
-            if not image_path:
-                continue
-
-            g_list = list(user_ids[uid]["join"])
-            gid = sorted(g_list, key=lambda g: user_ids[uid]["join"][g], reverse=True)[0]
+            joins = user_status.get_joins()
+            gid = sorted(joins, key=lambda g: joins[g], reverse=True)[0]
 
-            with Image.open(image_path) as image:
-                share_user_avatar(client, gid, uid, 0, image)
-
-            thread(delete_file, (image_path,))
+            add_avatar_job(client, gid, uid, 0, file_id, True)
 
         result = True
     except Exception as e:
@@ -145,7 +145,6 @@ def reset_data(client: Client) -> bool:
     result = False
 
     glovar.locks["white"].acquire()
-    glovar.locks["message"].acquire()
 
     try:
         glovar.bad_ids["users"] = set()
@@ -154,8 +153,7 @@ def reset_data(client: Client) -> bool:
         glovar.deleted_ids = {}
         save("deleted_ids")
 
-        glovar.user_ids = {}
-        save("user_ids")
+        clear_users()
 
         glovar.watch_ids = {
             "ban": {},
@@ -178,7 +176,6 @@ def reset_data(client: Client) -> bool:
     except Exception as e:
         logger.warning(f"Reset data error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
         glovar.locks["white"].release()
 
     return result
@@ -274,7 +271,7 @@ def white_check(client: Client) -> bool:
 
         # Get white ids
         for uid in list(glovar.white_wait_ids):
-            glovar.user_ids[uid]["message"] = {}
+            clear_user_messages(uid)
             gids = glovar.white_wait_ids.pop(uid, set())
 
             if is_class_d_user(uid):
@@ -283,7 +280,7 @@ def white_check(client: Client) -> bool:
             if is_high_score_user(uid, False) > 1.2:
                 continue
 
-            if any(glovar.user_ids[uid]["score"][project] for project in ["noflood", "warn"]):
+            if any(get_user_score(uid, project) for project in ["noflood", "warn"]):
                 continue
 
             if is_watch_user(uid, "delete", now) or is_watch_user(uid, "ban", now):
@@ -298,30 +295,26 @@ def white_check(client: Client) -> bool:
 
             glovar.white_ids.add(uid)
 
-        save("user_ids")
-        glovar.white_ids = glovar.white_ids | {uid for gid in list(glovar.trust_ids) for uid in glovar.trust_ids[gid]}
+        glovar.white_ids = glovar.white_ids | set(glovar.trusted_ids)
         save("white_ids")
         glovar.white_wait_ids = {}
         save("white_wait_ids")
 
         # Share white list
-        file = data_to_file(glovar.white_ids)
-        share_data(
+        file = data_to_file(glovar.white_ids, True)
+        file and share_data(
             client=client,
             receivers=glovar.receivers["white"],
             action="add",
             action_type="white",
-            file=file
+            file=file,
+            encrypt=False
         )
 
         # Get white wait ids
-        with glovar.locks["message"]:
-            user_ids = deepcopy(glovar.user_ids)
-
         for gid in list(glovar.admin_ids):
-            white_wait(client, gid, user_ids, now)
+            white_wait(client, gid, now)
 
-        save("user_ids")
         save("white_wait_ids")
 
         result = True
@@ -334,7 +327,7 @@ def white_check(client: Client) -> bool:
 
 
 @retry
-def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
+def white_wait(client: Client, gid: int, now: int) -> bool:
     # Get white wait ids
     result = False
 
@@ -344,7 +337,7 @@ def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
         if not members:
             return False
 
-        valid_members = filter(lambda m: m and m.user and user_ids.get(m.user.id, {}), members)
+        valid_members = filter(lambda m: m and m.user and glovar.user_ids.get(m.user.id, {}), members)
 
         for member in valid_members:
             if member.status != "member":
@@ -353,6 +346,11 @@ def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
             uid = member.user.id
             joined = member.joined_date
 
+            user_status = get_user_status(uid)
+
+            if not user_status:
+                continue
+
             if now - joined < glovar.time_old:
                 continue
 
@@ -362,7 +360,7 @@ def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
             if is_high_score_user(uid, False) > 1.2:
                 continue
 
-            if any(glovar.user_ids[uid]["score"][project] for project in ["noflood", "warn"]):
+            if any(user_status.get_score(project) for project in ["noflood", "warn"]):
                 continue
 
             if is_watch_user(uid, "delete", now) or is_watch_user(uid, "ban", now):
@@ -374,14 +372,13 @@ def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
             if glovar.white_wait_ids.get(uid, set()):
                 continue
 
-            if not any(len(messages) > glovar.limit_message
-                       for messages in [{mid for mid in user_ids[uid]["message"][group_id]
-                                         if mid not in glovar.deleted_ids[group_id]}
-                                        for group_id in list(user_ids[uid]["message"])]):
+            counts = user_status.get_counts()
+
+            if not any(count > glovar.limit_message for count in counts.values()):
                 continue
 
-            glovar.user_ids[uid]["message"] = {}
-            glovar.white_wait_ids[uid] = set(user_ids[uid]["message"])
+            clear_user_messages(uid)
+            glovar.white_wait_ids[uid] = set(counts)
 
         result = True
     except FloodWait as e:
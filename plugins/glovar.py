@@ -18,19 +18,26 @@
 
 import logging
 import pickle
+import re
 from codecs import getdecoder
 from configparser import RawConfigParser
-from os import mkdir
+from os import getpid, kill, mkdir
 from os.path import exists
 from shutil import rmtree
-from string import ascii_lowercase
-from threading import Lock
-from typing import Dict, List, Set, Union
+from signal import SIGTERM
+from string import ascii_lowercase, punctuation
+from threading import Lock, RLock, Thread, current_thread, main_thread
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Pattern, Set, Tuple, Union
 
 from emoji import UNICODE_EMOJI
 from yaml import safe_load
+from zhon.hanzi import punctuation as punctuation_zh
 
 from .checker import check_all
+from .storage import AvatarCache, DeletedIds, EmojiTrie, LRUCache, RecentIds, SQLiteStorage, SQLiteUsers, UserStatus
+from .storage import apply_user_op, convert_data, get_char_class, get_nonprintable_ranges, get_special_dict
+from .storage import get_special_table, get_trusted_ids, is_old_data
 
 # Enable logging
 logging.basicConfig(
@@ -85,20 +92,35 @@ lang: str = "cmn-Hans"
 normalize: Union[bool, str] = "True"
 
 # [limit]
+limit_cache: int = 67108864
+limit_declared: int = 1000
 limit_length: int = 30
 limit_message: int = 50
+limit_quality: int = 75
+limit_queue: int = 1000
+limit_thumbnail: int = 320
+limit_worker: int = 4
 
 # [mode]
 aio: Union[bool, str] = "False"
 backup: Union[bool, str] = "False"
+thumbnail: Union[bool, str] = "False"
+
+# [storage]
+backend: str = "pickle"
+cache_size: int = 10000
+preload: Union[bool, str] = "True"
 
 # [time]
 date_reset: str = "1st mon"
 time_begin: int = 0
 time_check: int = 5
+time_deleted: int = 86400
 time_end: int = 12
 time_new: int = 1800
 time_old: int = 7776000
+time_read: int = 5
+time_save: int = 5
 
 try:
     config = RawConfigParser()
@@ -146,22 +168,39 @@ try:
     normalize = eval(normalize)
 
     # [limit]
+    limit_cache = int(config.get("limit", "limit_cache", fallback=limit_cache))
+    limit_declared = int(config.get("limit", "limit_declared", fallback=limit_declared))
     limit_length = int(config.get("limit", "limit_length", fallback=limit_length))
     limit_message = int(config.get("limit", "limit_message", fallback=limit_message))
+    limit_quality = int(config.get("limit", "limit_quality", fallback=limit_quality))
+    limit_queue = int(config.get("limit", "limit_queue", fallback=limit_queue))
+    limit_thumbnail = int(config.get("limit", "limit_thumbnail", fallback=limit_thumbnail))
+    limit_worker = int(config.get("limit", "limit_worker", fallback=limit_worker))
 
     # [mode]
     aio = config.get("mode", "aio", fallback=aio)
     aio = eval(aio)
     backup = config.get("mode", "backup", fallback=backup)
     backup = eval(backup)
+    thumbnail = config.get("mode", "thumbnail", fallback=thumbnail)
+    thumbnail = eval(thumbnail)
+
+    # [storage]
+    backend = config.get("storage", "backend", fallback=backend)
+    cache_size = int(config.get("storage", "cache_size", fallback=cache_size))
+    preload = config.get("storage", "preload", fallback=preload)
+    preload = eval(preload)
 
     # [time]
     date_reset = config.get("time", "date_reset", fallback=date_reset)
     time_begin = int(config.get("time", "time_begin", fallback=time_begin))
     time_check = int(config.get("time", "time_check", fallback=time_check))
+    time_deleted = int(config.get("time", "time_deleted", fallback=time_deleted))
     time_end = int(config.get("time", "time_end", fallback=time_end))
     time_new = int(config.get("time", "time_new", fallback=time_new))
     time_old = int(config.get("time", "time_old", fallback=time_old))
+    time_read = int(config.get("time", "time_read", fallback=time_read))
+    time_save = int(config.get("time", "time_save", fallback=time_save))
 
     # [flag]
     broken = False
@@ -211,19 +250,34 @@ check_all(
             "normalize": normalize
         },
         "limit": {
+            "limit_cache": limit_cache,
+            "limit_declared": limit_declared,
             "limit_length": limit_length,
-            "limit_message": limit_message
+            "limit_message": limit_message,
+            "limit_quality": limit_quality,
+            "limit_queue": limit_queue,
+            "limit_thumbnail": limit_thumbnail,
+            "limit_worker": limit_worker
         },
         "mode": {
             "aio": aio,
-            "backup": backup
+            "backup": backup,
+            "thumbnail": thumbnail
+        },
+        "storage": {
+            "backend": backend,
+            "cache_size": cache_size,
+            "preload": preload
         },
         "time": {
             "date_reset": date_reset,
             "time_begin": time_begin,
             "time_check": time_check,
+            "time_deleted": time_deleted,
             "time_new": time_new,
-            "time_old": time_old
+            "time_old": time_old,
+            "time_read": time_read,
+            "time_save": time_save
         }
     },
     broken
@@ -241,40 +295,107 @@ except Exception as e:
 
 # Init
 
+avatar_hashes: RecentIds = RecentIds(256)
+# avatar_hashes = RecentIds(size=256, ids={
+#     17212562135614371593: 12345678
+# })
+
+avatar_jobs: Dict[int, Any] = {}
+# avatar_jobs = {
+#     12345678: AvatarJob(gid=-10012345678, uid=12345678, mid=123, file_id="file_id")
+# }
+
 bot_ids: Set[int] = {avatar_id, captcha_id, clean_id, index_id, lang_id, long_id,
                      noflood_id, noporn_id, nospam_id, tip_id, user_id, warn_id}
 
-declared_message_ids: Dict[int, Set[int]] = {}
+declared_message_ids: Dict[int, RecentIds] = {}
 # declared_message_ids = {
-#     -10012345678: {123}
+#     -10012345678: RecentIds(size=limit_declared, ids={123: True})
 # }
 
-default_user_status: Dict[str, Union[str, Dict[int, int]]] = {
-    "avatar": "",
-    "join": {},
-    "message": {},
-    "score": {
-        "captcha": 0.0,
-        "clean": 0.0,
-        "lang": 0.0,
-        "long": 0.0,
-        "noflood": 0.0,
-        "noporn": 0.0,
-        "nospam": 0.0,
-        "warn": 0.0
-    }
-}
+dirty_files: Set[str] = set()
+# dirty_files = {"user_ids"}
 
 emoji_set: Set[str] = set(UNICODE_EMOJI)
 
+emoji_trie: EmojiTrie = EmojiTrie(UNICODE_EMOJI)
+
+# The character classes removed from the texts, see etc.clean_text
+# Invalid: the non-printable characters, the punctuations and the single character emoji
+# Non-printable: the non-printable characters except the line breaks and the tabs
+nonprintable_ranges: List[Tuple[int, int]] = get_nonprintable_ranges()
+
+invalid_pattern: Pattern = re.compile(get_char_class(
+    punctuation + punctuation_zh + "".join(emoji for emoji in emoji_set if len(emoji) == 1),
+    nonprintable_ranges
+))
+
+nonprintable_pattern: Pattern = re.compile(get_char_class("", nonprintable_ranges, "\n\r\t"))
+
+# The lock shards of the groups and the users
+# Lock order: the global locks, then a group shard, then a user shard
+# The operations on all the users hold all the group shards and then all the user shards, see ids.lock_all
+group_locks: List[RLock] = [RLock() for _ in range(64)]
+
+hash_distance: int = 4
+
+journal_size: int = 16 * 1024 * 1024
+
+journals: Dict[str, List[tuple]] = {}
+# journals = {
+#     "user_ids": [("join", 12345678, -10012345678, 1512345678)]
+# }
+
 locks: Dict[str, Lock] = {
     "admin": Lock(),
-    "message": Lock(),
+    "avatar": Lock(),
+    "file": Lock(),
+    "pool": Lock(),
+    "read": Lock(),
     "receive": Lock(),
     "regex": Lock(),
+    "trust": Lock(),
     "white": Lock()
 }
 
+# The worker count and the queue size of each worker pool
+pool_sizes: Dict[str, Tuple[int, int]] = {
+    "avatar": (limit_worker, limit_queue),
+    "clean": (1, 10000),
+    "network": (8, 1000),
+    "timer": (2, 100)
+}
+
+pools: Dict[str, Any] = {}
+# pools = {
+#     "network": WorkerPool("network", 8, 1000)
+# }
+
+# The highest unread message id of the channels that have a pending read call
+read_ids: Dict[Tuple[str, int], int] = {}
+# read_ids = {
+#     ("history", -10012345678): 123
+# }
+
+read_times: Dict[Tuple[str, int], float] = {}
+# read_times = {
+#     ("history", -10012345678): 1512345678.0
+# }
+
+recent_message_ids: Dict[int, RecentIds] = {}
+# recent_message_ids = {
+#     -10012345678: RecentIds(size=recent_size, ids={123: 12345678})
+# }
+
+recent_size: int = 1000
+
+spool_size: int = 1024 * 1024
+
+# The normalized texts, only the texts up to the length are cached
+text_cache: LRUCache = LRUCache(10000)
+
+text_length: int = 256
+
 receivers: Dict[str, List[str]] = {
     "white": ["ANALYZE", "AVATAR", "CAPTCHA", "CLEAN", "INDEX", "LANG",
               "LONG", "MANAGE", "NOFLOOD", "NOPORN", "NOSPAM", "USER", "WATCH"]
@@ -295,8 +416,17 @@ regex: Dict[str, bool] = {
 for c in ascii_lowercase:
     regex[f"ad{c}"] = False
 
+ad_scanner: Any = None
+
+regex_engines: Dict[str, Any] = {}
+# regex_engines = {
+#     "ad": RuleEngine
+# }
+
 sender: str = "AVATAR"
 
+user_locks: List[RLock] = [RLock() for _ in range(64)]
+
 version: str = "0.2.8"
 
 # Load data from pickle
@@ -310,6 +440,9 @@ except Exception as e:
 for path in ["data", "tmp"]:
     not exists(path) and mkdir(path)
 
+# Init the avatar cache
+avatar_cache: AvatarCache = AvatarCache("data/avatar", limit_cache)
+
 # Init ids variables
 
 admin_ids: Dict[int, Set[int]] = {}
@@ -326,9 +459,9 @@ bad_ids: Dict[str, Set[int]] = {
 #     "users": {12345678}
 # }
 
-deleted_ids: Dict[int, Set[int]] = {}
+deleted_ids: Dict[int, DeletedIds] = {}
 # deleted_ids = {
-#     -10012345678: {123}
+#     -10012345678: DeletedIds(partitions={437585: array("q", [121, 122]), 437586: {123}})
 # }
 
 except_ids: Dict[str, Set[str]] = {
@@ -349,27 +482,19 @@ trust_ids: Dict[int, Set[int]] = {}
 #     -10012345678: {12345678}
 # }
 
-user_ids: Dict[int, Dict[str, Union[str, Dict[Union[int, str], Union[float, int, Set[int]]]]]] = {}
+# The trust index is built from trust_ids on first access, see ids.update_trust_ids
+# trusted_ids = Counter({
+#     12345678: 1
+# })
+
+user_ids: Dict[int, UserStatus] = {}
 # user_ids = {
-#     12345678: {
-#         "avatar": "",
-#         "join": {
-#             -10012345678: 1512345678
-#         },
-#         "message": {
-#             -10012345678: {123}
-#         },
-#         "score": {
-#             "captcha": 0.0,
-#             "clean": 0.0,
-#             "lang": 0.0,
-#             "long": 0.0,
-#             "noflood": 0.0,
-#             "noporn": 0.0,
-#             "nospam": 0.0,
-#             "warn": 0.0
-#         }
-#     }
+#     12345678: UserStatus(
+#         avatar="",
+#         join=array("q", [-10012345678, 1512345678]),
+#         message=array("q", [-10012345678, 1]),
+#         score=array("d", [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+#     )
 # }
 
 watch_ids: Dict[str, Dict[int, int]] = {
@@ -410,44 +535,176 @@ file_list: List[str] = ["admin_ids", "bad_ids", "deleted_ids", "except_ids", "fl
                         "trust_ids", "user_ids", "watch_ids", "white_ids", "white_kicked_ids", "white_wait_ids"]
 file_list += [f"{f}_words" for f in regex]
 
-for file in file_list:
+
+def load_pickle(name: str) -> Any:
+    # Load a data file, or its backup
+    try:
+        with open(f"data/{name}", "rb") as data_file:
+            return pickle.load(data_file)
+    except Exception as load_error:
+        logger.error(f"Load data {name} error: {load_error}", exc_info=True)
+
+    with open(f"data/.{name}", "rb") as data_file:
+        return pickle.load(data_file)
+
+
+def replay_journal(name: str, data: Any) -> Any:
+    # Replay the journal of a data file, the mutations after the last snapshot
     try:
+        if not exists(f"data/{name}.log"):
+            return data
+
+        with open(f"data/{name}.log", "rb") as journal_file:
+            while True:
+                try:
+                    apply_user_op(data, pickle.load(journal_file))
+                except EOFError:
+                    break
+    except Exception as replay_error:
+        # An incomplete record at the end of the journal is expected after a crash
+        logger.warning(f"Replay journal {name} error: {replay_error}", exc_info=True)
+
+    return data
+
+
+database: Optional[SQLiteStorage] = None
+
+if backend == "sqlite":
+    database = SQLiteStorage("data/data.db")
+
+# Keep the default values, each data file is loaded on its first access
+default_data: Dict[str, Any] = {file: globals().pop(file) for file in file_list}
+
+# The indexes built from the data files on first access
+derived_data: Dict[str, Tuple[str, Callable]] = {
+    "trusted_ids": ("trust_ids", get_trusted_ids)
+}
+
+load_failed: str = ""
+# load_failed = "user_ids"
+
+load_lock: RLock = RLock()
+
+load_times: Dict[str, float] = {}
+# load_times = {
+#     "user_ids": 0.5
+# }
+
+
+def __getattr__(name: str) -> Any:
+    # Load a data file on first access
+    if name in derived_data:
+        source, build = derived_data[name]
+
+        with load_lock:
+            return globals().setdefault(name, build(load_data(source)))
+
+    if name not in default_data:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    return load_data(name)
+
+
+def load_data(name: str) -> Any:
+    # Load a data file as a global variable
+    global load_failed
+
+    with load_lock:
+        if name in globals():
+            return globals()[name]
+
+        start = perf_counter()
+        saved = exists(f"data/{name}") or exists(f"data/.{name}")
+
+        # The old user records are counted without the deleted messages
+        deleted_ids = load_data("deleted_ids") if name == "user_ids" and saved else None
+
         try:
-            if exists(f"data/{file}") or exists(f"data/.{file}"):
-                with open(f"data/{file}", "rb") as f:
-                    locals()[f"{file}"] = pickle.load(f)
+            # Keep the users in tables, migrate the pickle data on first start
+            if database and name == "user_ids":
+                data = SQLiteUsers(database, cache_size)
+                if saved and not len(data):
+                    data.replace(replay_journal(name, convert_data(name, load_pickle(name), deleted_ids)))
+
+            # Keep the other datasets as blobs
+            elif database:
+                data = database.load(name)
+
+                # Migrate the pickle data, or save the default data, only when the dataset does not exist
+                if data is None:
+                    data = convert_data(name, load_pickle(name), deleted_ids) if saved else default_data[name]
+                    database.save(name, data)
+
+            elif saved:
+                data = load_pickle(name)
+
+                # Write the converted data back by the next flush, so the old records are converted only once
+                if is_old_data(name, data):
+                    data = convert_data(name, data, deleted_ids)
+
+                    with locks["file"]:
+                        dirty_files.add(name)
+
+                data = replay_journal(name, data) if name == "user_ids" else data
+
             else:
-                with open(f"data/{file}", "wb") as f:
-                    pickle.dump(eval(f"{file}"), f)
-        except Exception as e:
-            logger.error(f"Load data {file} error: {e}", exc_info=True)
+                data = default_data[name]
+
+                with open(f"data/{name}", "wb") as data_file:
+                    pickle.dump(data, data_file)
+        except Exception as load_error:
+            logger.critical(f"Load data {name} backup error: {load_error}", exc_info=True)
+            load_failed = load_failed or name
 
-            with open(f"data/.{file}", "rb") as f:
-                locals()[f"{file}"] = pickle.load(f)
-    except Exception as e:
-        logger.critical(f"Load data {file} backup error: {e}", exc_info=True)
-        raise SystemExit("[DATA CORRUPTION]")
+            # A lazy load in a worker thread stops the client, the main thread exits after app.idle() returns
+            thread = current_thread()
+            thread is not main_thread() and thread is not preload_thread and kill(getpid(), SIGTERM)
 
-# Generate special characters dictionary
-for special in ["spc", "spe"]:
-    locals()[f"{special}_dict"]: Dict[str, str] = {}
+            raise SystemExit("[DATA CORRUPTION]")
 
-    for rule in locals()[f"{special}_words"]:
-        # Check keys
-        if "[" not in rule:
-            continue
+        globals()[name] = data
+        load_times[name] = perf_counter() - start
 
-        # Check value
-        if "?#" not in rule:
-            continue
+    return data
 
-        keys = rule.split("]")[0][1:]
-        value = rule.split("?#")[1][1]
 
-        for k in keys:
-            locals()[f"{special}_dict"][k] = value
+def preload_data() -> None:
+    # Load the large data files first, then the others, the main thread checks load_failed after the load
+    try:
+        for name in ["user_ids", "deleted_ids"] + file_list:
+            load_data(name)
+    except SystemExit:
+        return
+
+    print(report_load())
+
+
+def report_load() -> str:
+    # Get the load time of each data file
+    result = "Data load time:\n"
+
+    for name in file_list:
+        if name in load_times:
+            result += f"    {name}: {load_times[name]:.3f}s\n"
+        else:
+            result += f"    {name}: not loaded\n"
+
+    return result
+
+
+# Generate special characters dictionaries and their merged translation table
+spc_dict: Dict[str, str] = get_special_dict(load_data("spc_words"))
+spe_dict: Dict[str, str] = get_special_dict(load_data("spe_words"))
+special_table: Dict[int, str] = get_special_table(spc_dict, spe_dict)
 
 # Start program
 copyright_text = (f"SCP-079-{sender} v{version}, Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>\n"
                   "Licensed under the terms of the GNU General Public License v3 or later (GPLv3+)\n")
 print(copyright_text)
+
+# Load the large data files while the client connects
+preload_thread: Optional[Thread] = None
+
+if preload:
+    preload_thread = Thread(target=preload_data, daemon=True)
+    preload_thread.start()
@@ -18,27 +18,28 @@
 
 import logging
 
-from PIL import Image
 from pyrogram import Client, Filters, Message
 
 from typing import List
 
 from .. import glovar
-from ..functions.channel import share_user_avatar
-from ..functions.etc import get_hour, get_full_name, get_now, get_text, thread
-from ..functions.file import delete_file, get_downloaded_path, save
+from ..functions.avatar import add_avatar_job
+from ..functions.channel import mark_read
+from ..functions.etc import clean_text, get_hour, get_full_name, get_now, get_text
+from ..functions.file import save
 from ..functions.filters import aio, authorized_group, class_d, declared_message, detect_nospam, from_user
 from ..functions.filters import hide_channel, is_ban_text, is_class_d_user, is_declared_message, is_high_score_user
-from ..functions.filters import is_nm_text, is_watch_user, is_valid_character, white_user
-from ..functions.ids import init_group_id, init_user_id
+from ..functions.filters import is_nm_text, is_watch_user, white_user
+from ..functions.ids import add_user_message, get_group_lock, get_user_avatar, get_user_join, init_group_id
+from ..functions.ids import init_user_id, remove_user_message, set_user_join
 from ..functions.receive import receive_add_bad, receive_add_except, receive_captcha_flood, receive_captcha_kicked_user
 from ..functions.receive import receive_captcha_kicked_users, receive_clear_data, receive_declared_message
 from ..functions.receive import receive_flood_score, receive_refresh, receive_regex, receive_remove_bad
 from ..functions.receive import receive_remove_except, receive_remove_score, receive_remove_white, receive_rollback
 from ..functions.receive import receive_status_ask, receive_text_data, receive_user_score, receive_version_ask
 from ..functions.receive import receive_warn_kicked_user, receive_watch_user
+from ..functions.regex import TextContext
 from ..functions.timers import backup_files, send_count
-from ..functions.telegram import read_history, read_mention
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -52,8 +53,6 @@ def check(_: Client, message: Message) -> bool:
     # Check message sent from users
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         gid = message.chat.id
@@ -85,37 +84,29 @@ def check(_: Client, message: Message) -> bool:
             return False
 
         # Check name
-        if is_nm_text(get_full_name(message.from_user, True, True, True)):
+        name_context = TextContext(get_full_name(message.from_user, True, True, True))
+
+        if is_nm_text(name_context):
             return False
 
         # Check message text
-        message_text = "".join(t for t in get_text(message) if is_valid_character(t)).strip()
+        message_text = clean_text(get_text(message)).strip()
 
         if not message_text:
             return False
 
-        if is_ban_text(message_text, False):
-            return False
+        text_context = TextContext(message_text)
 
-        if len(message_text) < glovar.limit_length:
+        if is_ban_text(text_context, False):
             return False
 
-        # Init user id
-        if not init_user_id(uid):
+        if len(message_text) < glovar.limit_length:
             return False
 
         # Record message id
-        if not glovar.user_ids[uid]["message"].get(gid, set()):
-            glovar.user_ids[uid]["message"][gid] = set()
-
-        glovar.user_ids[uid]["message"][gid].add(mid)
-        save("user_ids")
-
-        result = True
+        result = add_user_message(uid, gid, mid)
     except Exception as e:
         logger.warning(f"Check error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -128,8 +119,6 @@ def check_join(client: Client, message: Message) -> bool:
     # Check new joined user
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         gid = message.chat.id
@@ -169,9 +158,8 @@ def check_join(client: Client, message: Message) -> bool:
                 continue
 
             # Update user's join status
-            joined = glovar.user_ids[uid]["join"].get(gid)
-            glovar.user_ids[uid]["join"][gid] = now
-            save("user_ids")
+            joined = get_user_join(uid, gid)
+            set_user_join(uid, gid, now)
 
             # Check group status
             if glovar.nospam_id not in glovar.admin_ids[gid]:
@@ -182,29 +170,16 @@ def check_join(client: Client, message: Message) -> bool:
                 continue
 
             file_id = new.photo.big_file_id
-            file_ref = ""
-            old_id = glovar.user_ids[uid]["avatar"]
+            old_id = get_user_avatar(uid)
 
             if file_id == old_id and joined:
                 continue
 
-            glovar.user_ids[uid]["avatar"] = file_id
-            save("user_ids")
-            image_path = get_downloaded_path(client, file_id, file_ref)
-
-            if not image_path:
-                continue
-
-            with Image.open(image_path) as image:
-                share_user_avatar(client, gid, uid, mid, image)
-
-            thread(delete_file, (image_path,))
+            add_avatar_job(client, gid, uid, mid, file_id)
 
         result = True
     except Exception as e:
         logger.warning(f"Check join error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -223,7 +198,7 @@ def mark_mention(client: Client, message: Message) -> bool:
         if cid != glovar.hide_channel_id:
             return False
 
-        thread(read_mention, (client, cid))
+        mark_read(client, cid, message.message_id, "mention")
     except Exception as e:
         logger.warning(f"Mark mention error: {e}", exc_info=True)
 
@@ -244,7 +219,7 @@ def mark_message(client: Client, message: Message) -> bool:
         if cid != glovar.hide_channel_id:
             return False
 
-        thread(read_history, (client, cid))
+        mark_read(client, cid, message.message_id, "history")
     except Exception as e:
         logger.warning(f"Mark message error: {e}", exc_info=True)
 
@@ -463,10 +438,9 @@ def deleted(_: Client, messages: List[Message]) -> bool:
     # Deleted messages
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         group_list = set(glovar.admin_ids)
+        now = get_now()
 
         for message in messages:
             if not message.chat:
@@ -484,14 +458,14 @@ def deleted(_: Client, messages: List[Message]) -> bool:
             if not init_group_id(gid):
                 continue
 
-            glovar.deleted_ids[gid].add(mid)
+            with get_group_lock(gid):
+                glovar.deleted_ids[gid].add(mid, now, glovar.time_deleted)
+                remove_user_message(gid, mid)
 
         save("deleted_ids")
 
         result = True
     except Exception as e:
         logger.warning(f"Deleted error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
@@ -0,0 +1,853 @@
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import pickle
+import re
+import sqlite3
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from hashlib import sha256
+from os import listdir, makedirs, remove, replace, utime
+from os.path import basename, exists, getmtime, getsize, join
+from shutil import move
+from threading import Lock
+from time import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+# The time span of a partition of the deleted message ids
+deleted_span: int = 3600
+
+
+class AvatarCache:
+    # An on-disk LRU cache of the avatars, the files are named by the content hash
+    def __init__(self, path: str, size_limit: int):
+        self.path = path
+        self.size_limit = size_limit
+        self.lock = Lock()
+        self.files: OrderedDict = OrderedDict()
+        self.ids: Dict[str, str] = {}
+        self.shared: Dict[str, Set[int]] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+
+        makedirs(path, exist_ok=True)
+
+        # Remove the files that were being moved into the cache
+        for name in [name for name in listdir(path) if name.endswith(".tmp")]:
+            remove(join(path, name))
+
+        # Keep the files of the last run, the least recently used first
+        digests = [name for name in listdir(path) if not name.startswith(".")]
+
+        for digest in sorted(digests, key=lambda f: getmtime(join(path, f))):
+            self.files[digest] = getsize(join(path, digest))
+            self.size += self.files[digest]
+
+        # Keep the file ids and the shared users of the kept files
+        try:
+            if exists(join(path, ".index")):
+                with open(join(path, ".index"), "rb") as f:
+                    ids, shared = pickle.load(f)
+
+                self.ids = {file_id: ids[file_id] for file_id in ids if ids[file_id] in self.files}
+                self.shared = {digest: shared[digest] for digest in shared if digest in self.files}
+        except Exception as e:
+            logger.warning(f"Load avatar index error: {e}", exc_info=True)
+
+        self.evict()
+
+    def evict(self) -> None:
+        # Remove the least recently used files until the cache fits the size limit
+        while self.size > self.size_limit and self.files:
+            digest, size = self.files.popitem(last=False)
+            self.size -= size
+            self.changed = True
+            self.shared.pop(digest, None)
+
+            for file_id in [file_id for file_id in self.ids if self.ids[file_id] == digest]:
+                self.ids.pop(file_id, None)
+
+            exists(join(self.path, digest)) and remove(join(self.path, digest))
+
+    def get(self, file_id: str) -> str:
+        # Get the cached file path of a file id
+        with self.lock:
+            digest = self.ids.get(file_id)
+
+            if not digest or digest not in self.files:
+                self.misses += 1
+                return ""
+
+            self.hits += 1
+            self.files.move_to_end(digest)
+            utime(join(self.path, digest))
+
+            return join(self.path, digest)
+
+    def is_shared(self, path: str, uid: int) -> bool:
+        # Check if the file has been shared for the user
+        with self.lock:
+            return uid in self.shared.get(basename(path), set())
+
+    def mark_shared(self, path: str, uid: int) -> None:
+        # Mark the file as shared for the user
+        with self.lock:
+            if basename(path) not in self.files:
+                return
+
+            self.shared.setdefault(basename(path), set()).add(uid)
+            self.changed = True
+
+    def put(self, file_id: str, file_path: str) -> str:
+        # Move a downloaded file into the cache, return the cached file path
+        with open(file_path, "rb") as f:
+            digest = sha256(f.read()).hexdigest()
+
+        path = join(self.path, digest)
+
+        with self.lock:
+            if digest in self.files:
+                remove(file_path)
+                self.files.move_to_end(digest)
+                utime(path)
+            else:
+                # The tmp directory may be on another file system, copy the file next to the cache first
+                move(file_path, f"{path}.tmp")
+                replace(f"{path}.tmp", path)
+                self.files[digest] = getsize(path)
+                self.size += self.files[digest]
+
+            self.ids[file_id] = digest
+            self.changed = True
+            self.evict()
+
+        return path if digest in self.files else ""
+
+    def save(self) -> None:
+        # Save the file ids and the shared users if they are changed, so the cache is still found after a restart
+        with self.lock:
+            if not self.changed:
+                return
+
+            with open(join(self.path, ".index.tmp"), "wb") as f:
+                pickle.dump((self.ids, self.shared), f)
+
+            replace(join(self.path, ".index.tmp"), join(self.path, ".index"))
+            self.changed = False
+
+
+class DeletedIds:
+    # Deleted message ids of a group, partitioned by the deletion time
+    # Only the current partition is a set, the older ones are sealed as sorted arrays
+    __slots__ = ("partitions",)
+
+    def __init__(self, mids: Iterable[int] = (), now: int = 0):
+        self.partitions: Dict[int, Union[Set[int], array]] = {}
+        mids and self.partitions.setdefault(now // deleted_span, set()).update(mids)
+
+    def __contains__(self, mid: int) -> bool:
+        for partition in self.partitions.values():
+            if isinstance(partition, set):
+                if mid in partition:
+                    return True
+
+                continue
+
+            i = bisect_left(partition, mid)
+
+            if i < len(partition) and partition[i] == mid:
+                return True
+
+        return False
+
+    def __getstate__(self) -> Dict[int, array]:
+        # Persist all the partitions as sorted arrays
+        return {key: seal_ids(partition) for key, partition in list(self.partitions.items())}
+
+    def __len__(self) -> int:
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def __setstate__(self, state: Dict[int, array]) -> None:
+        self.partitions = dict(state)
+
+    def add(self, mid: int, now: int, horizon: int) -> None:
+        # Add a deleted message id, drop the partitions out of the horizon
+        key = now // deleted_span
+
+        if key not in self.partitions:
+            self.expire(now - horizon)
+
+            for old_key, partition in list(self.partitions.items()):
+                self.partitions[old_key] = seal_ids(partition)
+
+            self.partitions[key] = set()
+
+        partition = self.partitions[key]
+
+        # The partition may be sealed after a restart
+        if not isinstance(partition, set):
+            partition = self.partitions[key] = set(partition)
+
+        partition.add(mid)
+
+    def expire(self, since: int) -> None:
+        # Drop the partitions that ended before the time
+        for key in [key for key in self.partitions if (key + 1) * deleted_span <= since]:
+            self.partitions.pop(key, None)
+
+
+class EmojiTrie:
+    # Prefix tree of the emoji, scan a text for the longest matched emoji in one pass
+    __slots__ = ("root",)
+
+    def __init__(self, emojis: Iterable[str]):
+        # Each node maps a character to the next node, the empty key marks the end of an emoji
+        self.root: Dict[str, dict] = {}
+
+        for emoji in emojis:
+            node = self.root
+
+            for c in emoji:
+                node = node.setdefault(c, {})
+
+            node[""] = True
+
+    def scan(self, text: str, excluded: str = "") -> Counter:
+        # Count the emoji in the text, the emoji that are part of the excluded text are not counted
+        result = Counter()
+        root = self.root
+        i = 0
+        size = len(text)
+
+        while i < size:
+            node = root.get(text[i])
+
+            if node is None:
+                i += 1
+                continue
+
+            end = 0
+            j = i + 1
+
+            while True:
+                if "" in node:
+                    end = j
+
+                if j >= size:
+                    break
+
+                node = node.get(text[j])
+
+                if node is None:
+                    break
+
+                j += 1
+
+            if not end:
+                i += 1
+                continue
+
+            emoji = text[i:end]
+
+            if emoji not in excluded:
+                result[emoji] += 1
+
+            i = end
+
+        return result
+
+
+class UserStatus:
+    # Status of a user, packed to keep a large number of records small
+    # The join times and the message counts are packed arrays of group id and value pairs, the empty ones are None
+    # The message counts only keep the count of the valid messages in each group
+    __slots__ = ("avatar", "join", "message", "score")
+
+    # The projects that give scores, in the order of the score array
+    projects: Tuple[str, ...] = ("captcha", "clean", "lang", "long", "noflood", "noporn", "nospam", "warn")
+
+    def __init__(self):
+        self.avatar: str = ""
+        self.join: Optional[array] = None
+        self.message: Optional[array] = None
+        self.score: Optional[array] = None
+
+    def copy(self) -> "UserStatus":
+        # Get a copy of the record
+        result = UserStatus()
+        result.avatar = self.avatar
+        result.join = self.join and array("q", self.join)
+        result.message = self.message and array("q", self.message)
+        result.score = self.score and array("d", self.score)
+
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict, deleted_ids: Optional[dict] = None) -> "UserStatus":
+        # Convert a record of the old dict format, the deleted messages are not counted
+        result = cls()
+        result.avatar = data.get("avatar", "")
+
+        for gid, joined in data.get("join", {}).items():
+            result.set_join(gid, joined)
+
+        for gid, mids in data.get("message", {}).items():
+            deleted = (deleted_ids or {}).get(gid, ())
+            result.set_count(gid, len([mid for mid in mids if mid not in deleted]))
+
+        for project, score in data.get("score", {}).items():
+            result.set_score(project, score)
+
+        return result
+
+    def get_count(self, gid: int) -> int:
+        # Get the count of the messages in a group
+        return get_pair(self.message, gid)
+
+    def get_counts(self) -> Dict[int, int]:
+        # Get the count of the messages in each group
+        return get_pairs(self.message)
+
+    def get_join(self, gid: int) -> int:
+        # Get the join time in a group
+        return get_pair(self.join, gid)
+
+    def get_joins(self) -> Dict[int, int]:
+        # Get the join time in each group
+        return get_pairs(self.join)
+
+    def get_score(self, project: str = "") -> float:
+        # Get the score of a project, or the total score
+        if not self.score:
+            return 0.0
+
+        if not project:
+            return sum(self.score)
+
+        if project not in self.projects:
+            return 0.0
+
+        return self.score[self.projects.index(project)]
+
+    def remove_join(self, gid: int) -> None:
+        # Remove the join status in a group
+        self.join = set_pair(self.join, gid, 0)
+
+    def set_count(self, gid: int, count: int) -> None:
+        # Set the count of the messages in a group
+        self.message = set_pair(self.message, gid, count)
+
+    def set_join(self, gid: int, joined: int) -> None:
+        # Set the join time in a group
+        self.join = set_pair(self.join, gid, joined)
+
+    def set_score(self, project: str, score: float) -> None:
+        # Set the score of a project
+        if project not in self.projects:
+            return
+
+        if self.score is None:
+            if not score:
+                return
+
+            self.score = array("d", bytes(8 * len(self.projects)))
+
+        self.score[self.projects.index(project)] = score
+
+
+def apply_user_op(user_ids: dict, op: tuple) -> bool:
+    # Apply a mutation to the user_ids dict
+    the_type, uid = op[0], op[1]
+
+    if the_type == "reset":
+        user_ids[uid] = UserStatus()
+        return True
+
+    status = user_ids.get(uid)
+
+    if status is None:
+        status = user_ids[uid] = UserStatus()
+
+    if the_type == "avatar":
+        status.avatar = op[2]
+    elif the_type == "clean":
+        status.message = None
+    elif the_type == "count":
+        status.set_count(op[2], op[3])
+    elif the_type == "join":
+        status.set_join(op[2], op[3])
+    elif the_type == "leave":
+        status.remove_join(op[2])
+    elif the_type == "score":
+        status.set_score(op[2], op[3])
+    else:
+        return False
+
+    return True
+
+
+def convert_data(name: str, data: Any, deleted_ids: Optional[dict] = None) -> Any:
+    # Convert a dataset of the old format, the deleted message ids are needed by user_ids
+    if name == "deleted_ids":
+        for gid, mids in list(data.items()):
+            if not isinstance(mids, DeletedIds):
+                data[gid] = DeletedIds(mids, int(time()))
+    elif name == "user_ids":
+        data = convert_users(data, deleted_ids)
+
+    return data
+
+
+def convert_users(user_ids: dict, deleted_ids: Optional[dict] = None) -> Dict[int, UserStatus]:
+    # Convert the records of the old dict format
+    for uid, status in list(user_ids.items()):
+        if isinstance(status, dict):
+            user_ids[uid] = UserStatus.from_dict(status, deleted_ids)
+
+    return user_ids
+
+
+def get_char_class(chars: Iterable[str], ranges: Iterable[Tuple[int, int]], keep: str = "") -> str:
+    # Get a regex character class of the characters and the code point ranges, except the kept characters
+    kept = sorted({ord(c) for c in keep})
+    parts = [re.escape(c) for c in sorted(set(chars) - set(keep))]
+
+    for start, end in ranges:
+        for point in (point for point in kept if start <= point <= end):
+            start < point and parts.append(f"\\U{start:08x}-\\U{point - 1:08x}")
+            start = point + 1
+
+        start <= end and parts.append(f"\\U{start:08x}-\\U{end:08x}")
+
+    return f"[{''.join(parts)}]"
+
+
+def get_nonprintable_ranges() -> List[Tuple[int, int]]:
+    # Get the code point ranges of the non-printable characters
+    result = []
+    start = None
+
+    for point in range(0x110000):
+        if not chr(point).isprintable():
+            start = point if start is None else start
+        elif start is not None:
+            result.append((start, point - 1))
+            start = None
+
+    start is not None and result.append((start, 0x10FFFF))
+
+    return result
+
+
+def get_pair(pairs: Optional[array], key: int) -> int:
+    # Get the value of a key in a packed array of key and value pairs
+    if not pairs:
+        return 0
+
+    for i in range(0, len(pairs), 2):
+        if pairs[i] == key:
+            return pairs[i + 1]
+
+    return 0
+
+
+def get_pairs(pairs: Optional[array]) -> Dict[int, int]:
+    # Get a packed array of key and value pairs as a dict
+    if not pairs:
+        return {}
+
+    return dict(zip(pairs[::2], pairs[1::2]))
+
+
+def get_special_dict(words: Iterable[str]) -> Dict[str, str]:
+    # Get the special characters dictionary from the rules like "[ab](?# c)"
+    result = {}
+
+    for rule in words:
+        # Check keys
+        if "[" not in rule:
+            continue
+
+        # Check value
+        if "?#" not in rule:
+            continue
+
+        keys = rule.split("]")[0][1:]
+        value = rule.split("?#")[1][1]
+
+        for k in keys:
+            result[k] = value
+
+    return result
+
+
+def get_special_table(spc_dict: Dict[str, str], spe_dict: Dict[str, str]) -> Dict[int, str]:
+    # Get the translation table that applies the spc dictionary and then the spe dictionary
+    result = {ord(k): v for k, v in spe_dict.items()}
+
+    for k, v in spc_dict.items():
+        result[ord(k)] = spe_dict.get(v, v)
+
+    return result
+
+
+def get_trusted_ids(trust_ids: Dict[int, Set[int]]) -> Counter:
+    # Get the trust index, the count of the groups that trust each user
+    result = Counter()
+
+    for uids in list(trust_ids.values()):
+        result.update(uids)
+
+    return result
+
+
+def is_old_data(name: str, data: Any) -> bool:
+    # Check whether a dataset has records of the old format, which convert_data changes
+    if name == "deleted_ids":
+        return any(not isinstance(mids, DeletedIds) for mids in data.values())
+    elif name == "user_ids":
+        return any(isinstance(status, dict) for status in data.values())
+
+    return False
+
+
+def seal_ids(ids: Union[Set[int], array]) -> array:
+    # Get the sorted array form of the ids
+    if isinstance(ids, array):
+        return ids
+
+    return array("q", sorted(ids))
+
+
+def set_pair(pairs: Optional[array], key: int, value: int) -> Optional[array]:
+    # Set the value of a key in a packed array of key and value pairs, a value of 0 removes the key
+    # Return the array, or None if it is empty
+    pairs = pairs or array("q")
+
+    for i in range(0, len(pairs), 2):
+        if pairs[i] != key:
+            continue
+
+        if value:
+            pairs[i + 1] = value
+        else:
+            del pairs[i:i + 2]
+
+        return pairs or None
+
+    value and pairs.extend((key, value))
+
+    return pairs or None
+
+
+class LRUCache:
+    # A bounded thread-safe cache of computed values, the least recently used ones are dropped first
+    __slots__ = ("size", "items", "lock", "generation", "hits", "misses")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.items: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def clear(self) -> None:
+        # Drop all the values, the values computed before are not cached any more
+        with self.lock:
+            self.items.clear()
+            self.generation += 1
+
+    def get(self, key: Any) -> Any:
+        # Get a cached value, or None
+        with self.lock:
+            result = self.items.get(key)
+
+            if result is None:
+                self.misses += 1
+                return None
+
+            self.items.move_to_end(key)
+            self.hits += 1
+
+        return result
+
+    def put(self, key: Any, value: Any, generation: int) -> None:
+        # Cache a value computed in the generation, drop the least recently used ones if the cache is full
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.items[key] = value
+            self.items.move_to_end(key)
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class RecentIds:
+    # A bounded map of the recent ids, the oldest ids are dropped first
+    __slots__ = ("size", "ids")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.ids: Dict[int, Any] = {}
+
+    def __contains__(self, the_id: int) -> bool:
+        return the_id in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, the_id: int, value: Any = True) -> None:
+        # Add an id, drop the oldest one if the map is full
+        self.ids[the_id] = value
+
+        while len(self.ids) > self.size:
+            del self.ids[next(iter(self.ids))]
+
+    def pop(self, the_id: int, default: Any = None) -> Any:
+        # Remove an id, return its value
+        return self.ids.pop(the_id, default)
+
+
+class SQLiteStorage:
+    # A local SQLite database in WAL mode
+    def __init__(self, path: str):
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS datasets (name TEXT PRIMARY KEY, data BLOB NOT NULL)")
+
+    def execute(self, sql: str, args: tuple = ()) -> List[tuple]:
+        # Run a statement and fetch all the rows
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def execute_many(self, statements: List[tuple]) -> None:
+        # Run statements in one transaction
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+
+                for sql, args in statements:
+                    self.conn.execute(sql, args)
+
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def load(self, name: str) -> Any:
+        # Load a dataset, return None if it does not exist
+        rows = self.execute("SELECT data FROM datasets WHERE name = ?", (name,))
+
+        if not rows:
+            return None
+
+        return pickle.loads(rows[0][0])
+
+    def save(self, name: str, data: Any) -> None:
+        # Save a dataset
+        self.save_blob(name, pickle.dumps(data))
+
+    def save_blob(self, name: str, blob: bytes) -> None:
+        # Save a pickled dataset
+        self.execute("INSERT OR REPLACE INTO datasets (name, data) VALUES (?, ?)", (name, blob))
+
+
+class SQLiteUsers(Mapping):
+    # The user_ids stored in SQLite tables, with a small LRU cache of the records
+    def __init__(self, storage: SQLiteStorage, cache_size: int):
+        self.storage = storage
+        self.projects = UserStatus.projects
+        self.cache: OrderedDict = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = Lock()
+
+        columns = ", ".join(f"{project} REAL NOT NULL DEFAULT 0.0" for project in self.projects)
+        self.storage.execute_many([
+            (f"CREATE TABLE IF NOT EXISTS users "
+             f"(id INTEGER PRIMARY KEY, avatar TEXT NOT NULL DEFAULT '', {columns})", ()),
+            ("CREATE TABLE IF NOT EXISTS joins "
+             "(user_id INTEGER NOT NULL, group_id INTEGER NOT NULL, time INTEGER NOT NULL, "
+             "PRIMARY KEY (user_id, group_id)) WITHOUT ROWID", ()),
+            ("CREATE INDEX IF NOT EXISTS joins_time ON joins (time)", ()),
+            ("CREATE TABLE IF NOT EXISTS counts "
+             "(user_id INTEGER NOT NULL, group_id INTEGER NOT NULL, count INTEGER NOT NULL, "
+             "PRIMARY KEY (user_id, group_id)) WITHOUT ROWID", ())
+        ])
+
+    def __getitem__(self, uid: int) -> UserStatus:
+        # The record is read and cached under the cache lock,
+        # so an invalidation by a mutation always comes after the fill and is never undone
+        with self.cache_lock:
+            if uid in self.cache:
+                self.cache.move_to_end(uid)
+                return self.cache[uid]
+
+            result = self.read(uid)
+
+            if result is None:
+                raise KeyError(uid)
+
+            self.cache[uid] = result
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return result
+
+    def __iter__(self) -> Iterator[int]:
+        return iter([row[0] for row in self.storage.execute("SELECT id FROM users")])
+
+    def __len__(self) -> int:
+        return self.storage.execute("SELECT COUNT(*) FROM users")[0][0]
+
+    def apply(self, op: tuple) -> bool:
+        # Apply a mutation to the tables
+        the_type, uid = op[0], op[1]
+        statements = [("INSERT OR IGNORE INTO users (id) VALUES (?)", (uid,))]
+
+        if the_type == "reset":
+            statements = [("INSERT OR REPLACE INTO users (id) VALUES (?)", (uid,)),
+                          ("DELETE FROM joins WHERE user_id = ?", (uid,)),
+                          ("DELETE FROM counts WHERE user_id = ?", (uid,))]
+        elif the_type == "avatar":
+            statements.append(("UPDATE users SET avatar = ? WHERE id = ?", (op[2], uid)))
+        elif the_type == "clean":
+            statements.append(("DELETE FROM counts WHERE user_id = ?", (uid,)))
+        elif the_type == "count" and op[3] > 0:
+            statements.append(("INSERT OR REPLACE INTO counts (user_id, group_id, count) VALUES (?, ?, ?)",
+                               (uid, op[2], op[3])))
+        elif the_type == "count":
+            statements.append(("DELETE FROM counts WHERE user_id = ? AND group_id = ?", (uid, op[2])))
+        elif the_type == "join":
+            statements.append(("INSERT OR REPLACE INTO joins (user_id, group_id, time) VALUES (?, ?, ?)",
+                               (uid, op[2], op[3])))
+        elif the_type == "leave":
+            statements.append(("DELETE FROM joins WHERE user_id = ? AND group_id = ?", (uid, op[2])))
+        elif the_type == "score" and op[2] in self.projects:
+            statements.append((f"UPDATE users SET {op[2]} = ? WHERE id = ?", (op[3], uid)))
+        else:
+            return False
+
+        self.storage.execute_many(statements)
+
+        with self.cache_lock:
+            self.cache.pop(uid, None)
+
+        return True
+
+    def clear(self) -> None:
+        # Remove all the users
+        self.storage.execute_many([("DELETE FROM users", ()), ("DELETE FROM joins", ()),
+                                   ("DELETE FROM counts", ())])
+
+        with self.cache_lock:
+            self.cache.clear()
+
+    def clear_joins(self) -> None:
+        # Remove all the join status
+        self.storage.execute("DELETE FROM joins")
+
+        with self.cache_lock:
+            self.cache.clear()
+
+    def get_new(self, since: int) -> List[int]:
+        # Get the users joined after the time
+        return [row[0] for row in self.storage.execute("SELECT DISTINCT user_id FROM joins WHERE time > ?", (since,))]
+
+    def get_watching_count(self) -> int:
+        # Get the count of the users that have message records
+        return self.storage.execute("SELECT COUNT(DISTINCT user_id) FROM counts")[0][0]
+
+    def read(self, uid: int) -> Optional[UserStatus]:
+        # Read a record from the tables
+        rows = self.storage.execute(f"SELECT avatar, {', '.join(self.projects)} FROM users WHERE id = ?", (uid,))
+
+        if not rows:
+            return None
+
+        result = UserStatus()
+        result.avatar = rows[0][0]
+
+        for project, score in zip(self.projects, rows[0][1:]):
+            result.set_score(project, score)
+
+        for gid, joined in self.storage.execute("SELECT group_id, time FROM joins WHERE user_id = ?", (uid,)):
+            result.set_join(gid, joined)
+
+        for gid, count in self.storage.execute("SELECT group_id, count FROM counts WHERE user_id = ?", (uid,)):
+            result.set_count(gid, count)
+
+        return result
+
+    def replace(self, data: Dict[int, UserStatus]) -> None:
+        # Replace all the users with a user_ids dict
+        columns = ", ".join(self.projects)
+        marks = ", ".join("?" for _ in self.projects)
+        statements = [("DELETE FROM users", ()), ("DELETE FROM joins", ()), ("DELETE FROM counts", ())]
+
+        for uid, status in data.items():
+            scores = tuple(status.get_score(project) for project in self.projects)
+            statements.append((f"INSERT INTO users (id, avatar, {columns}) VALUES (?, ?, {marks})",
+                               (uid, status.avatar) + scores))
+            statements += [("INSERT INTO joins (user_id, group_id, time) VALUES (?, ?, ?)", (uid, gid, joined))
+                           for gid, joined in status.get_joins().items()]
+            statements += [("INSERT INTO counts (user_id, group_id, count) VALUES (?, ?, ?)", (uid, gid, count))
+                           for gid, count in status.get_counts().items()]
+
+        self.storage.execute_many(statements)
+
+        with self.cache_lock:
+            self.cache.clear()
+
+    def to_dict(self) -> Dict[int, UserStatus]:
+        # Export all the users as a user_ids dict
+        result = {}
+
+        for row in self.storage.execute(f"SELECT id, avatar, {', '.join(self.projects)} FROM users"):
+            result[row[0]] = UserStatus()
+            result[row[0]].avatar = row[1]
+
+            for project, score in zip(self.projects, row[2:]):
+                result[row[0]].set_score(project, score)
+
+        for uid, gid, joined in self.storage.execute("SELECT user_id, group_id, time FROM joins"):
+            if uid in result:
+                result[uid].set_join(gid, joined)
+
+        for uid, gid, count in self.storage.execute("SELECT user_id, group_id, count FROM counts"):
+            if uid in result:
+                result[uid].set_count(gid, count)
+
+        return result